@@ -0,0 +1,10 @@
+"""Configure the application for the tests, before recall is imported
+
+The tests use the local SQLite configuration, and correct recalls and
+store autosaves in the request, without the journal and queue files.
+"""
+import os
+
+os.environ.setdefault('FLASK_DEBUG', '1')
+os.environ.setdefault('RECALL_AUTOSAVE_JOURNAL', '')
+os.environ.setdefault('RECALL_CORRECTION_QUEUE', '')
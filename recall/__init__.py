@@ -23,9 +23,45 @@ if not localhost:
     )
 else:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.db'
-app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
+# RECALL_DATABASE_URI overrides the database, for example to migrate
+# a copy of it, see recall.migrate
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    'RECALL_DATABASE_URI', SQLALCHEMY_DATABASE_URI)
 app.config["SQLALCHEMY_POOL_RECYCLE"] = 280
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Correct recalls on every autosave (live scoring), not only when
+# the final submit locks the recall.
+app.config['LIVE_CORRECTION'] = bool(os.environ.get('RECALL_LIVE_CORRECTION'))
+# Local journal of intermediate autosaves, written to the database
+# every AUTOSAVE_FLUSH_INTERVAL seconds. Empty to disable.
+app.config['AUTOSAVE_JOURNAL'] = os.environ.get('RECALL_AUTOSAVE_JOURNAL',
+                                                'autosave_journal.db')
+app.config['AUTOSAVE_FLUSH_INTERVAL'] = 60  # Seconds
+# Scheduling of autosaves, see recall.schedule
+app.config['AUTOSAVE_INTERVAL'] = 10  # Seconds
+app.config['AUTOSAVE_MAX_INTERVAL'] = 60  # Seconds
+app.config['AUTOSAVE_CAPACITY'] = 20  # Autosaves per second
+# Queue of recalls to correct in background, see recall.corrections.
+# ':memory:' for an in-process queue, empty to correct in the request.
+app.config['CORRECTION_QUEUE'] = os.environ.get('RECALL_CORRECTION_QUEUE',
+                                                'correction_queue.db')
+app.config['CORRECTION_WORKERS'] = 2
+app.config['CORRECTION_RETRIES'] = 3
+# Store generated numbers and cards as a seed instead of the data
+app.config['SEEDED_MEMOS'] = True
+# Processes rendering .xls sheets in parallel, see recall.sheets
+app.config['XLS_PROCESSES'] = os.cpu_count() or 1
+# Render the sheet of a new memorization before it is downloaded
+app.config['XLS_PRERENDER'] = True
+# Size in bytes the cache of rendered sheets is kept within
+app.config['XLS_CACHE_BYTES'] = int(os.environ.get(
+    'RECALL_XLS_CACHE_BYTES', 512*1024*1024))
+# Let the front web server send sheets, audio and image PDFs:
+# 'x-accel' (nginx) or 'x-sendfile' (Apache, lighttpd). Empty to send
+# them from Flask. See views._send_file.
+app.config['SENDFILE'] = os.environ.get('RECALL_SENDFILE', '')
+app.config['SENDFILE_PREFIX'] = os.environ.get('RECALL_SENDFILE_PREFIX',
+                                               '/protected')
 db = SQLAlchemy(app)
 
 login_manager = LoginManager()
@@ -45,3 +81,17 @@ if localhost and restart:
     ])
 db.create_all()
 
+import recall.journal
+import recall.corrections
+
+
+@app.before_first_request
+def start_background_threads():
+    """Start the journal flush and the correction workers
+
+    Not done at import, so the database can be migrated before they
+    use it, and so they run in the process serving the requests.
+    """
+    recall.journal.start()
+    recall.corrections.start()
+
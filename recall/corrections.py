@@ -0,0 +1,334 @@
+"""Correct recalls in background workers
+
+Final submits, and re-corrections asked for by the owner of a
+memorization, are only stored by the request and answered at once.
+The correction is done by a pool of CORRECTION_WORKERS threads taking
+jobs from a queue, and the recall page polls for the result.
+
+The queue backend is given by CORRECTION_QUEUE: ':memory:' for a queue
+in the memory of this process, otherwise the path of a local SQLite
+database shared by all processes of the application. SQLite older than
+3.35 can't take jobs atomically, then the queue is in memory. An empty
+value disables the workers and recalls are corrected in the request.
+
+A job is keyed by recall id and the version (seq) of the recall, so
+the same submit is queued and corrected only once, and a job for an
+outdated version is dropped. A failing job is retried after a delay,
+at most CORRECTION_RETRIES times. The Correction row, with the seq it
+corrected, is how a finished job is published to the recall views.
+A locked recall without a Correction of its latest version, and a
+recall its owner asked to re-correct, is queued again when the
+application starts.
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+import sqlalchemy.orm
+
+from recall import app, db, metrics
+from recall import models
+
+# claim identifies the taken job in its queue, see SQLiteQueue.get
+Job = collections.namedtuple(
+    'Job', ['recall_id', 'seq', 'full', 'attempts', 'not_before', 'claim'])
+
+# Seconds a SQLite job is held by a worker before others may take it
+CLAIM_TIMEOUT = 60
+# Seconds a worker waits after failing to take or finish a job
+ERROR_DELAY = 5
+# SQLite version with UPDATE ... RETURNING, used by SQLiteQueue
+SQLITE_RETURNING = (3, 35, 0)
+
+
+class MemoryQueue:
+    """Correction jobs in the memory of this process"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # (recall_id, seq) -> Job
+        self.jobs = collections.OrderedDict()
+
+    def put(self, recall_id, seq, full=False):
+        with self.condition:
+            job = self.jobs.get((recall_id, seq))
+            if job is None:
+                job = Job(recall_id, seq, full, 0, 0.0, None)
+            self.jobs[(recall_id, seq)] = job._replace(full=job.full or full)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Take the next job, None if there is none within timeout"""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                for key, job in self.jobs.items():
+                    if job.not_before <= now:
+                        del self.jobs[key]
+                        return job
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(min(remaining, 1))
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, delay):
+        with self.condition:
+            self.jobs.setdefault(
+                (job.recall_id, job.seq),
+                job._replace(attempts=job.attempts + 1,
+                             not_before=time.time() + delay))
+            self.condition.notify()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.jobs)
+
+
+class SQLiteQueue:
+    """Correction jobs in a local SQLite database
+
+    A job is a row, its generation counts the puts of it. A job put
+    again while a worker has taken it is not done when that worker is
+    done, it is taken again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        # Wakes up the workers of this process
+        self.event = threading.Event()
+
+    def _connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS correction_job ('
+                'recall_id INTEGER NOT NULL, '
+                'seq INTEGER NOT NULL, '
+                'full_correction INTEGER NOT NULL, '
+                'attempts INTEGER NOT NULL, '
+                'not_before REAL NOT NULL, '
+                'claimed_until REAL NOT NULL, '
+                'generation INTEGER NOT NULL DEFAULT 0, '
+                'PRIMARY KEY (recall_id, seq))'
+            )
+            columns = [row[1] for row in connection.execute(
+                'PRAGMA table_info(correction_job)')]
+            if 'generation' not in columns:
+                # Queue created before generations were counted
+                try:
+                    connection.execute(
+                        'ALTER TABLE correction_job '
+                        'ADD COLUMN generation INTEGER NOT NULL DEFAULT 0')
+                except sqlite3.OperationalError:
+                    # Added by another process meanwhile
+                    pass
+            self.local.connection = connection
+        return self.local.connection
+
+    def put(self, recall_id, seq, full=False):
+        self._connection().execute(
+            'INSERT INTO correction_job VALUES (?, ?, ?, 0, 0, 0, 0) '
+            'ON CONFLICT (recall_id, seq) DO UPDATE '
+            'SET full_correction = max(full_correction, '
+            'excluded.full_correction), generation = generation + 1',
+            (recall_id, seq, int(full)))
+        self.event.set()
+
+    def get(self, timeout):
+        """Take the next job, None if there is none within timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            row = self._connection().execute(
+                'UPDATE correction_job SET claimed_until = ? '
+                'WHERE rowid = (SELECT rowid FROM correction_job '
+                'WHERE not_before <= ? AND claimed_until <= ? '
+                'ORDER BY not_before LIMIT 1) '
+                'RETURNING recall_id, seq, full_correction, attempts, '
+                'not_before, rowid, generation',
+                (now + CLAIM_TIMEOUT, now, now)).fetchone()
+            if row is not None:
+                recall_id, seq, full, attempts, not_before = row[0:5]
+                return Job(recall_id, seq, bool(full), attempts, not_before,
+                           claim=row[5:7])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Other processes can't wake us up, so poll now and then
+            self.event.wait(min(remaining, 0.5))
+            self.event.clear()
+
+    def done(self, job):
+        connection = self._connection()
+        rowid, generation = job.claim
+        deleted = connection.execute(
+            'DELETE FROM correction_job WHERE rowid = ? AND generation = ?',
+            (rowid, generation)).rowcount
+        if not deleted:
+            # Put again meanwhile, for example a full re-correction
+            connection.execute(
+                'UPDATE correction_job SET attempts = 0, claimed_until = 0 '
+                'WHERE rowid = ?', (rowid,))
+            self.event.set()
+
+    def retry(self, job, delay):
+        self._connection().execute(
+            'UPDATE correction_job SET attempts = attempts + 1, '
+            'not_before = ?, claimed_until = 0 WHERE rowid = ?',
+            (time.time() + delay, job.claim[0]))
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT count(*) FROM correction_job').fetchone()[0]
+
+
+_queue = None
+
+
+def correct(recall, arbeiter='Arbeiter', **kwargs):
+    """Correct recall and add the result to its Correction
+
+    The caller commits the session.
+    """
+    raw_score, points, cbc_r = recall.correct(**kwargs)
+
+    if recall.correction:
+        app.logger.debug(f'{arbeiter}: Re-correcting recall {recall.id}')
+        recall.correction.__init__(raw_score, points, cbc_r)
+    else:
+        app.logger.debug(
+            f'{arbeiter}: Correcting recall {recall.id} for the first time')
+        correction = models.Correction(raw_score, points, cbc_r)
+        correction.recall = recall
+        db.session.add(correction)
+    recall.correction.seq = recall.seq
+    app.logger.info(recall.correction)
+
+
+def is_corrected(recall):
+    """True if the latest version of recall is corrected"""
+    return (recall.correction is not None
+            and recall.correction.seq == recall.seq)
+
+
+def is_pending(recall):
+    """True if recall is queued to be corrected by the workers
+
+    A locked recall is queued when submitted, or when the application
+    starts, and any recall when its owner asks for a re-correction.
+    """
+    return (enabled() and not is_corrected(recall)
+            and (recall.locked or (recall.correction is not None
+                                   and recall.correction.seq is None)))
+
+
+def enabled():
+    return _queue is not None
+
+
+def enqueue(recall_id, seq, full=False):
+    """Queue correction of version seq of recall
+
+    If full is True the recall is corrected from scratch, even if
+    this version is already corrected.
+    """
+    _queue.put(recall_id, seq, full)
+    metrics.incr('correction.queued')
+
+
+def _run(job):
+    with app.app_context():
+        try:
+            recall = models.RecallData.query.options(
+                sqlalchemy.orm.joinedload(
+                    models.RecallData.memo).undefer('_data'),
+                sqlalchemy.orm.joinedload(models.RecallData.correction)
+            ).filter_by(id=job.recall_id).one_or_none()
+            if recall is None or recall.seq != job.seq:
+                # Deleted, or a newer version has its own job
+                return
+            if is_corrected(recall) and not job.full:
+                return
+            correct(recall, 'Corrector', incremental=not job.full)
+            db.session.commit()
+            metrics.incr('correction.done')
+        finally:
+            db.session.remove()
+
+
+def _work(job):
+    try:
+        _run(job)
+    except Exception:
+        if job.attempts + 1 < app.config['CORRECTION_RETRIES']:
+            app.logger.warning(f'Failed to correct recall '
+                               f'{job.recall_id}, will retry')
+            metrics.incr('correction.retried')
+            _queue.retry(job, delay=2**job.attempts)
+            return
+        app.logger.exception(f'Failed to correct recall {job.recall_id}')
+        metrics.incr('correction.failed')
+    _queue.done(job)
+
+
+def _work_forever():
+    while True:
+        # The queue may fail too, for example a locked SQLite database.
+        # A job taken but not finished is taken again after
+        # CLAIM_TIMEOUT.
+        try:
+            job = _queue.get(timeout=10)
+            if job is not None:
+                _work(job)
+        except Exception:
+            app.logger.exception('Correction worker failed')
+            metrics.incr('correction.worker_errors')
+            time.sleep(ERROR_DELAY)
+
+
+def start():
+    """Queue uncorrected locked recalls and start the workers"""
+    global _queue
+    path = app.config['CORRECTION_QUEUE']
+    if not path:
+        return
+    if path == ':memory:':
+        _queue = MemoryQueue()
+    elif sqlite3.sqlite_version_info < SQLITE_RETURNING:
+        app.logger.warning(f'SQLite {sqlite3.sqlite_version} can\'t take '
+                           f'jobs from {path}, they are queued in memory')
+        _queue = MemoryQueue()
+    else:
+        _queue = SQLiteQueue(path)
+    recall_table = models.RecallData.__table__
+    correction_table = models.Correction.__table__
+    # A Correction without seq is outdated by a re-correction, see
+    # views.recorrect
+    recorrect = sqlalchemy.and_(correction_table.c.id != None,
+                                correction_table.c.seq == None)
+    query = sqlalchemy.select(
+        [recall_table.c.id, recall_table.c.seq,
+         recorrect.label('full_correction')]
+    ).select_from(recall_table.outerjoin(
+        correction_table, correction_table.c.recall_id == recall_table.c.id)
+    ).where(sqlalchemy.or_(
+        recorrect,
+        sqlalchemy.and_(recall_table.c.locked == True, sqlalchemy.or_(
+            correction_table.c.seq == None,
+            correction_table.c.seq != recall_table.c.seq))))
+    with app.app_context():
+        with db.engine.connect() as connection:
+            for row in connection.execute(query):
+                enqueue(row.id, row.seq, full=bool(row.full_correction))
+    for i in range(app.config['CORRECTION_WORKERS']):
+        thread = threading.Thread(target=_work_forever,
+                                  name=f'corrector-{i}', daemon=True)
+        thread.start()
@@ -0,0 +1,256 @@
+"""Compact binary encodings of data stored in the database
+
+Recall cells
+------------
+A recall is a list of strings, one per cell, and most of them are a
+single digit or empty. They are stored as a header (format byte and
+number of cells) followed by the cells in the most compact format
+that can hold all of them:
+
+    BINARY  2 bits per cell, for '', '0' and '1' (Binary)
+    NIBBLES 4 bits per cell, for '' and '0' to '9' (Numbers, Spoken)
+    BYTES   1 byte per cell, for '' and '0' to '254' (Cards)
+    TEXT    Length-prefixed UTF-8 per cell (Words, Dates)
+
+Recalls stored before this encoding are pickled lists, which start
+with the pickle protocol byte 0x80, and are decoded as before.
+
+Corrected cells
+---------------
+The Item value (0 to 5) of each cell of a correction is stored in
+3 bits, eight cells in three bytes, after a header with format ITEMS.
+
+Memorization data
+-----------------
+Each MemoData subclass has a data_format for its items:
+
+    MEMO_BITS    1 bit per item (Binary)
+    MEMO_NIBBLES 4 bits per item (Numbers, Spoken)
+    MEMO_BYTES   1 byte per item (Cards)
+    MEMO_TEXT    Length-prefixed UTF-8 per item (Words)
+    MEMO_DATES   Date, recall order and length-prefixed UTF-8 story
+                 per item (Historical Dates)
+
+A data_format of None, and data stored before this encoding, is a
+pickled sequence.
+"""
+import pickle
+import struct
+
+import sqlalchemy.types
+
+# Format of encoded recall cells, first byte of the encoding
+BINARY = 1
+NIBBLES = 2
+BYTES = 3
+TEXT = 4
+ITEMS = 5
+# Format of encoded memorization data
+MEMO_BITS = 16
+MEMO_NIBBLES = 17
+MEMO_BYTES = 18
+MEMO_TEXT = 19
+MEMO_DATES = 20
+
+HEADER = struct.Struct('<BI')  # Format, number of cells
+PICKLE_PROTOCOL = 0x80
+
+# Code of empty cell in each format
+EMPTY_CELL = {BINARY: 3, NIBBLES: 15, BYTES: 255}
+
+_BINARY_CODES = {'': 3, '0': 0, '1': 1}
+_NIBBLE_CODES = dict({'': 15}, **{str(i): i for i in range(10)})
+_BYTE_CODES = dict({'': 255}, **{str(i): i for i in range(255)})
+
+
+def _cell_format(cells):
+    """Most compact format of cells"""
+    values = set(cells)
+    if values <= _BINARY_CODES.keys():
+        return BINARY
+    elif values <= _NIBBLE_CODES.keys():
+        return NIBBLES
+    elif values <= _BYTE_CODES.keys():
+        return BYTES
+    return TEXT
+
+
+def _write_varint(buffer, n):
+    while n >= 0x80:
+        buffer.append(n & 0x7F | 0x80)
+        n >>= 7
+    buffer.append(n)
+
+
+def _read_varint(data, offset):
+    n = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+
+def pack_cells(cells):
+    """Encode list of recall cells to bytes"""
+    cell_format = _cell_format(cells)
+    buffer = bytearray(HEADER.pack(cell_format, len(cells)))
+    if cell_format == BINARY:
+        codes = [_BINARY_CODES[cell] for cell in cells]
+        codes += [EMPTY_CELL[BINARY]]*(-len(codes) % 4)
+        buffer += bytes(a << 6 | b << 4 | c << 2 | d for a, b, c, d
+                        in zip(*[iter(codes)]*4))
+    elif cell_format == NIBBLES:
+        codes = [_NIBBLE_CODES[cell] for cell in cells]
+        codes += [EMPTY_CELL[NIBBLES]]*(len(codes) % 2)
+        buffer += bytes(a << 4 | b for a, b in zip(*[iter(codes)]*2))
+    elif cell_format == BYTES:
+        buffer += bytes(_BYTE_CODES[cell] for cell in cells)
+    else:
+        for cell in cells:
+            _write_text(buffer, cell)
+    return bytes(buffer)
+
+
+def unpack_cells(data):
+    """Decode bytes of pack_cells, or a pickled list, to recall cells"""
+    if data[0] == PICKLE_PROTOCOL:
+        return pickle.loads(data)
+    cell_format, nr_cells = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    if cell_format == BINARY:
+        codes = [byte >> shift & 3 for byte in body for shift in (6, 4, 2, 0)]
+        return ['' if code == EMPTY_CELL[BINARY] else str(code)
+                for code in codes[0:nr_cells]]
+    elif cell_format == NIBBLES:
+        codes = [byte >> shift & 15 for byte in body for shift in (4, 0)]
+        return ['' if code == EMPTY_CELL[NIBBLES] else str(code)
+                for code in codes[0:nr_cells]]
+    elif cell_format == BYTES:
+        return ['' if code == EMPTY_CELL[BYTES] else str(code)
+                for code in body]
+    elif cell_format == TEXT:
+        cells = list()
+        offset = HEADER.size
+        for _ in range(nr_cells):
+            cell, offset = _read_text(data, offset)
+            cells.append(cell)
+        return cells
+    raise ValueError(f'Unknown format of recall cells: {cell_format}')
+
+
+def pack_items(codes):
+    """Encode list of Item values to bytes"""
+    buffer = bytearray(HEADER.pack(ITEMS, len(codes)))
+    codes = list(codes) + [0]*(-len(codes) % 8)
+    for i in range(0, len(codes), 8):
+        value = 0
+        for code in codes[i:i + 8]:
+            value = value << 3 | code
+        buffer += value.to_bytes(3, 'big')
+    return bytes(buffer)
+
+
+def unpack_items(data):
+    """Decode bytes of pack_items, or a pickled list of Items"""
+    if data[0] == PICKLE_PROTOCOL:
+        return [item.value for item in pickle.loads(data)]
+    item_format, nr_items = HEADER.unpack_from(data)
+    if item_format != ITEMS:
+        raise ValueError(f'Unknown format of corrected cells: {item_format}')
+    codes = list()
+    for i in range(HEADER.size, len(data), 3):
+        value = int.from_bytes(data[i:i + 3], 'big')
+        codes.extend(value >> shift & 7 for shift in range(21, -1, -3))
+    return codes[0:nr_items]
+
+
+def _write_text(buffer, text):
+    text = text.encode('utf-8')
+    _write_varint(buffer, len(text))
+    buffer += text
+
+
+def _read_text(data, offset):
+    length, offset = _read_varint(data, offset)
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def pack_memo(data, memo_format):
+    """Encode memorization data to bytes in memo_format"""
+    if memo_format is None:
+        return pickle.dumps(tuple(data))
+    buffer = bytearray(HEADER.pack(memo_format, len(data)))
+    if memo_format == MEMO_BITS:
+        digits = list(data) + [0]*(-len(data) % 8)
+        for i in range(0, len(digits), 8):
+            byte = 0
+            for digit in digits[i:i + 8]:
+                byte = byte << 1 | digit
+            buffer.append(byte)
+    elif memo_format == MEMO_NIBBLES:
+        digits = list(data) + [0]*(len(data) % 2)
+        buffer += bytes(a << 4 | b for a, b in zip(*[iter(digits)]*2))
+    elif memo_format == MEMO_BYTES:
+        buffer += bytes(data)
+    elif memo_format == MEMO_TEXT:
+        for word in data:
+            _write_text(buffer, word)
+    elif memo_format == MEMO_DATES:
+        for date, story, recall_order in data:
+            _write_varint(buffer, date)
+            _write_varint(buffer, recall_order)
+            _write_text(buffer, story)
+    else:
+        raise ValueError(f'Unknown format of memorization data: '
+                         f'{memo_format}')
+    return bytes(buffer)
+
+
+def unpack_memo(data):
+    """Decode bytes of pack_memo to tuple of memorization items"""
+    if data[0] == PICKLE_PROTOCOL:
+        return tuple(pickle.loads(data))
+    memo_format, nr_items = HEADER.unpack_from(data)
+    body = data[HEADER.size:]
+    if memo_format == MEMO_BITS:
+        return tuple(byte >> shift & 1 for byte in body
+                     for shift in range(7, -1, -1))[0:nr_items]
+    elif memo_format == MEMO_NIBBLES:
+        return tuple(byte >> shift & 15 for byte in body
+                     for shift in (4, 0))[0:nr_items]
+    elif memo_format == MEMO_BYTES:
+        return tuple(body)
+    items = list()
+    offset = HEADER.size
+    if memo_format == MEMO_TEXT:
+        for _ in range(nr_items):
+            word, offset = _read_text(data, offset)
+            items.append(word)
+    elif memo_format == MEMO_DATES:
+        for _ in range(nr_items):
+            date, offset = _read_varint(data, offset)
+            recall_order, offset = _read_varint(data, offset)
+            story, offset = _read_text(data, offset)
+            items.append((date, story, recall_order))
+    else:
+        raise ValueError(f'Unknown format of memorization data: '
+                         f'{memo_format}')
+    return tuple(items)
+
+
+class RecallCells(sqlalchemy.types.TypeDecorator):
+    """List of recall cells stored with pack_cells"""
+    impl = sqlalchemy.types.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return pack_cells(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return unpack_cells(bytes(value))
@@ -0,0 +1,233 @@
+"""Write-behind journal of intermediate recall autosaves
+
+Intermediate autosaves don't need to reach the main database every
+ten seconds, only the final locked submit must. An autosave of an
+existing recall is instead stored in a local SQLite database (in WAL
+mode, so every write is appended to its log). There is one entry per
+recall, so repeated autosaves of the same recall are coalesced.
+
+The entries are written to the main database by a background thread
+every AUTOSAVE_FLUSH_INTERVAL seconds, when the application exits,
+and when it starts, so entries not flushed before a crash are
+replayed. A
+final submit writes the recall directly and discards its entry.
+
+A flush never overwrites a recall with a higher sequence number, so a
+flush racing with a final submit can't undo it. The entries of a
+deleted recall, memorization or user are discarded before it is
+deleted. If the recall of an entry is missing anyway, the entry is
+inserted as a new recall, unless its memorization or user is gone too.
+"""
+import atexit
+import collections
+import pickle
+import sqlite3
+import threading
+import time
+
+import sqlalchemy
+
+from recall import app, db, metrics
+from recall import models
+
+# Looks like a row of the recall select in views.arbeiter
+Entry = collections.namedtuple(
+    'Entry', ['memo_user_id', 'id', 'user_id', 'locked', 'seq', 'digest',
+              'data'])
+
+_local = threading.local()
+_flush_lock = threading.Lock()
+
+
+def enabled():
+    return bool(app.config['AUTOSAVE_JOURNAL'])
+
+
+def _connection():
+    if getattr(_local, 'connection', None) is None:
+        connection = sqlite3.connect(app.config['AUTOSAVE_JOURNAL'],
+                                     timeout=10, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS autosave ('
+            'memo_id INTEGER NOT NULL, '
+            'user_id INTEGER NOT NULL, '
+            'recall_id INTEGER NOT NULL, '
+            'memo_user_id INTEGER, '
+            'seq INTEGER NOT NULL, '
+            'recall_values BLOB NOT NULL, '
+            'PRIMARY KEY (memo_id, user_id))'
+        )
+        _local.connection = connection
+    return _local.connection
+
+
+def get(memo_id, user_id):
+    """Get unflushed autosave of recall, None if there is none"""
+    row = _connection().execute(
+        'SELECT memo_user_id, recall_id, recall_values FROM autosave '
+        'WHERE memo_id = ? AND user_id = ?', (memo_id, user_id)).fetchone()
+    if row is None:
+        return None
+    memo_user_id, recall_id, recall_values = row
+    values = pickle.loads(recall_values)
+    return Entry(memo_user_id, recall_id, user_id, values['locked'],
+                 values['seq'], values.get('digest'), values['data'])
+
+
+def put(memo_id, user_id, recall_id, memo_user_id, values):
+    """Store autosave of recall, replacing the previous one
+
+    values are the new field values of the recall.
+    """
+    _connection().execute(
+        'INSERT OR REPLACE INTO autosave VALUES (?, ?, ?, ?, ?, ?)',
+        (memo_id, user_id, recall_id, memo_user_id, values['seq'],
+         pickle.dumps(values)))
+    metrics.incr('autosave.journaled')
+
+
+def discard(memo_id, user_id):
+    """Forget the autosave of recall, it is stored by other means
+
+    Waits for a flush in progress, in any process, so a recall
+    deleted after it is discarded is not stored again by the flush.
+    """
+    _connection().execute(
+        'DELETE FROM autosave WHERE memo_id = ? AND user_id = ?',
+        (memo_id, user_id))
+
+
+def discard_memos(memo_ids):
+    """Forget the autosaves of all recalls of memorizations"""
+    _connection().executemany(
+        'DELETE FROM autosave WHERE memo_id = ?',
+        [(memo_id,) for memo_id in memo_ids])
+
+
+def discard_user(user_id):
+    """Forget the autosaves of all recalls of user"""
+    _connection().execute('DELETE FROM autosave WHERE user_id = ?',
+                          (user_id,))
+
+
+def _insert_missing(db_connection, rows):
+    """Insert recalls of rows no longer in the main database
+
+    Only if their memorization and user exist and the user has no
+    other recall of it. Returns nr of recalls inserted.
+    """
+    table = models.RecallData.__table__
+    memo_table = models.MemoData.__table__
+    user_table = models.User.__table__
+    recall_ids = {row.id for row in db_connection.execute(
+        sqlalchemy.select([table.c.id]).where(
+            table.c.id.in_([row[2] for row in rows])))}
+    missing = [row for row in rows if row[2] not in recall_ids]
+    if not missing:
+        return 0
+    memo_ids = [row[0] for row in missing]
+    memos = {row.id for row in db_connection.execute(
+        sqlalchemy.select([memo_table.c.id]).where(
+            memo_table.c.id.in_(memo_ids)))}
+    users = {row.id for row in db_connection.execute(
+        sqlalchemy.select([user_table.c.id]).where(
+            user_table.c.id.in_([row[1] for row in missing])))}
+    recalls = {tuple(row) for row in db_connection.execute(
+        sqlalchemy.select([table.c.memo_id, table.c.user_id]).where(
+            table.c.memo_id.in_(memo_ids)))}
+    inserted = 0
+    for memo_id, user_id, recall_id, seq, recall_values in missing:
+        if (memo_id not in memos or user_id not in users
+                or (memo_id, user_id) in recalls):
+            app.logger.warning(f'Dropped autosave of recall {recall_id}, '
+                               f'memo {memo_id}, user {user_id} or its '
+                               f'recall changed')
+            metrics.incr('autosave.dropped')
+            continue
+        values = pickle.loads(recall_values)
+        values.update(memo_id=memo_id, user_id=user_id)
+        db_connection.execute(table.insert().values(**values))
+        app.logger.warning(f'Recall {recall_id} of memo {memo_id} was '
+                           f'missing, stored its autosave as a new recall')
+        inserted += 1
+    return inserted
+
+
+def flush():
+    """Write all autosaves to the main database"""
+    with _flush_lock:
+        connection = _connection()
+        # Held until the autosaves are written, so they are not
+        # discarded by another process meanwhile
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            nr_rows = _flush(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return nr_rows
+
+
+def _flush(connection):
+    rows = connection.execute(
+        'SELECT memo_id, user_id, recall_id, seq, recall_values '
+        'FROM autosave').fetchall()
+    if not rows:
+        return 0
+    table = models.RecallData.__table__
+    update = table.update().where(
+        table.c.id == sqlalchemy.bindparam('b_id')
+    ).where(
+        table.c.seq < sqlalchemy.bindparam('b_seq')
+    )
+    params = list()
+    for memo_id, user_id, recall_id, seq, recall_values in rows:
+        values = pickle.loads(recall_values)
+        values.update(b_id=recall_id, b_seq=seq)
+        params.append(values)
+    with app.app_context():
+        with db.engine.begin() as db_connection:
+            result = db_connection.execute(update, params)
+            # Not updated, a newer version is stored, or the recall is
+            # gone and the autosave would be lost
+            if result.rowcount != len(params):
+                _insert_missing(db_connection, rows)
+    # Entries replaced during the flush are kept for the next one
+    connection.executemany(
+        'DELETE FROM autosave WHERE memo_id = ? AND user_id = ? '
+        'AND seq = ?', [row[0:2] + row[3:4] for row in rows])
+    metrics.incr('autosave.flushed', len(rows))
+    app.logger.debug(f'Flushed {len(rows)} autosaves')
+    return len(rows)
+
+
+def _flush_forever():
+    while True:
+        time.sleep(app.config['AUTOSAVE_FLUSH_INTERVAL'])
+        try:
+            flush()
+        except Exception:
+            app.logger.exception('Failed to flush autosave journal')
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        app.logger.exception('Failed to flush autosave journal at exit')
+
+
+def start():
+    """Replay unflushed autosaves and start flushing in background
+
+    The autosaves are also flushed when the process exits.
+    """
+    if not enabled():
+        return
+    flush()
+    atexit.register(_flush_at_exit)
+    thread = threading.Thread(target=_flush_forever, name='journal',
+                              daemon=True)
+    thread.start()
@@ -0,0 +1,38 @@
+"""Count what the server is doing
+
+The counters live in the process and are shown at /metrics.
+
+The SQL statements executed while handling a request are counted
+and logged, so the number of database round-trips of each view can
+be followed.
+"""
+import collections
+
+from flask import g, has_request_context, request
+import sqlalchemy.engine
+import sqlalchemy.event
+
+from recall import app
+
+counters = collections.Counter()
+
+
+def incr(name, n=1):
+    counters[name] += n
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'before_cursor_execute')
+def _count_query(*args):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+@app.after_request
+def _log_query_count(response):
+    query_count = g.get('query_count', 0)
+    incr(f'requests.{request.endpoint}')
+    incr(f'queries.{request.endpoint}', query_count)
+    app.logger.debug(f'{request.endpoint}: {query_count} queries')
+    if app.debug or app.testing:
+        response.headers['X-Query-Count'] = str(query_count)
+    return response
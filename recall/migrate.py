@@ -0,0 +1,160 @@
+"""Migrate a database created by an earlier version of the application
+
+Adds the new columns of memo_data, recall_data and correction if they
+are missing, and fills them in for the rows stored before them.
+Encodes the data of rows stored before recall.encoding.pack_memo in
+the data_format of their discipline. The rows are converted
+BATCH_SIZE at a time, one transaction per batch, so the table is
+never locked for long and an interrupted migration can just be run
+again. The indexes the tables are paged by are created if they are
+missing, and recall_data is made unique per memorization and user,
+keeping the latest recall of each.
+
+Run it before the application serves requests again:
+
+    python -m recall.migrate
+"""
+import sqlalchemy
+
+from recall import app, db
+from recall import models
+import recall.encoding
+
+BATCH_SIZE = 500
+
+
+# New columns, their SQL types and the statement filling them in for
+# the rows stored before them, run when the column is added
+COLUMNS = [
+    ('memo_data', 'nr_items', 'INTEGER', None),
+    ('memo_data', 'prng', 'INTEGER', None),
+    ('memo_data', 'seed', 'BIGINT', None),
+    ('recall_data', 'seq', 'INTEGER NOT NULL DEFAULT 0',
+     'UPDATE recall_data SET seq = 0 WHERE seq IS NULL'),
+    # NULL, the digest of cells stored before is unknown, so the next
+    # autosave is taken as changed
+    ('recall_data', 'digest', 'VARCHAR(32)', None),
+    # Corrections stored before are of the only version of their recall.
+    # NULL would queue all of them for correction when the app starts.
+    ('correction', 'seq', 'INTEGER',
+     'UPDATE correction SET seq = (SELECT recall_data.seq FROM recall_data '
+     'WHERE recall_data.id = correction.recall_id) WHERE seq IS NULL'),
+]
+
+
+def add_columns():
+    inspector = sqlalchemy.inspect(db.engine)
+    for table, name, sql_type, backfill in COLUMNS:
+        columns = {c['name'] for c in inspector.get_columns(table)}
+        if name not in columns:
+            app.logger.info(f'Adding column {table}.{name}')
+            with db.engine.begin() as connection:
+                connection.execute(
+                    f'ALTER TABLE {table} ADD COLUMN {name} {sql_type}')
+                if backfill is not None:
+                    connection.execute(backfill)
+
+
+def add_indexes():
+    inspector = sqlalchemy.inspect(db.engine)
+    for model in (models.User, models.MemoData, models.RecallData):
+        table = model.__table__
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                app.logger.info(f'Adding index {index.name}')
+                index.create(db.engine)
+
+
+def remove_duplicate_recalls():
+    """Keep the latest recall of each memorization and user
+
+    Return nr of recalls removed, together with their corrections.
+    """
+    table = models.RecallData.__table__
+    correction_table = models.Correction.__table__
+    removed = 0
+    with db.engine.begin() as connection:
+        duplicates = connection.execute(
+            sqlalchemy.select([table.c.memo_id, table.c.user_id,
+                               sqlalchemy.func.max(table.c.id)])
+            .group_by(table.c.memo_id, table.c.user_id)
+            .having(sqlalchemy.func.count() > 1)
+        ).fetchall()
+        for memo_id, user_id, keep_id in duplicates:
+            ids = [row.id for row in connection.execute(
+                sqlalchemy.select([table.c.id])
+                .where(table.c.memo_id == memo_id)
+                .where(table.c.user_id == user_id)
+                .where(table.c.id != keep_id))]
+            connection.execute(correction_table.delete().where(
+                correction_table.c.recall_id.in_(ids)))
+            connection.execute(table.delete().where(table.c.id.in_(ids)))
+            app.logger.info(f'Removed recalls {ids} of memo {memo_id} and '
+                            f'user {user_id}, kept recall {keep_id}')
+            removed += len(ids)
+    return removed
+
+
+def add_unique_recalls():
+    """Make (memo_id, user_id) of recall_data unique"""
+    inspector = sqlalchemy.inspect(db.engine)
+    columns = ['memo_id', 'user_id']
+    unique = inspector.get_unique_constraints('recall_data') + [
+        i for i in inspector.get_indexes('recall_data') if i['unique']]
+    if any(u['column_names'] == columns for u in unique):
+        return
+    remove_duplicate_recalls()
+    app.logger.info('Adding unique index uq_recall_data_memo_user')
+    with db.engine.begin() as connection:
+        connection.execute('CREATE UNIQUE INDEX uq_recall_data_memo_user '
+                           'ON recall_data (memo_id, user_id)')
+
+
+def convert_memo_data():
+    """Encode pickled memorization data, return nr of rows converted"""
+    table = models.MemoData.__table__
+    polymorphic_map = models.MemoData.__mapper__.polymorphic_map
+    update = table.update().where(
+        table.c.id == sqlalchemy.bindparam('b_id'))
+    last_id = 0
+    converted = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                sqlalchemy.select([table.c.id, table.c.discipline,
+                                   table.c.data, table.c.nr_items])
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return converted
+            params = list()
+            for row in rows:
+                data = bytes(row.data)
+                if not data:
+                    # Seeded memorization, there is no data
+                    continue
+                pickled = data[0] == recall.encoding.PICKLE_PROTOCOL
+                if not pickled and row.nr_items is not None:
+                    continue
+                items = recall.encoding.unpack_memo(data)
+                cls = polymorphic_map[row.discipline].class_
+                params.append(dict(
+                    b_id=row.id,
+                    data=recall.encoding.pack_memo(items, cls.data_format),
+                    nr_items=len(items)
+                ))
+            if params:
+                connection.execute(update, params)
+            converted += len(params)
+            last_id = rows[-1].id
+        app.logger.info(f'Converted {converted} memos, last id {last_id}')
+
+
+if __name__ == '__main__':
+    add_columns()
+    add_indexes()
+    add_unique_recalls()
+    print(f'Converted {convert_memo_data()} memos')
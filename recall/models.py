@@ -10,25 +10,40 @@ Dependency
     AlmostCorrectWord -> User, Language
     Word -> Language
     Story -> Language
+    CacheVersion
 
 """
 import enum
 from datetime import datetime
+import hashlib
 import re
 import io
 import math
 import random
 import collections
+import functools
 import itertools
 
+import flask
 import sqlalchemy.orm
 from passlib.hash import sha256_crypt
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from recall import db, SCORE
+import recall.encoding
 import recall.xls
 
 NR_CARDS_IN_DECK = 52
 
+# Pseudo random generators of seeded memorizations, see MemoData.prng
+PRNG_SPLITMIX64 = 1
+MASK64 = 2**64 - 1
+# Largest number of items generated for a memorization
+MAX_NR_ITEMS = 20000
+
 
 class Discipline(enum.Enum):
     """Define valid disciplines and their official names"""
@@ -96,6 +111,8 @@ class User(db.Model):
     settings = db.Column(db.PickleType)
     blocked = db.Column(db.Boolean)
 
+    __table_args__ = (db.Index('ix_user_datetime', 'datetime', 'id'),)
+
     # Relationships
     memos = db.relationship('MemoData', backref="user",
                             cascade="save-update, merge, delete",
@@ -185,7 +202,14 @@ class MemoData(db.Model):
     discipline = db.Column(db.Enum(Discipline), nullable=False)
     memo_time = db.Column(db.Integer, nullable=False)  # Seconds
     recall_time = db.Column(db.Integer, nullable=False)  # Seconds
-    data = db.Column(db.PickleType, nullable=False)
+    # Items encoded in data_format, see recall.encoding.pack_memo.
+    # Only loaded when the items are used, listings use nr_items.
+    _data = db.deferred(db.Column('data', db.LargeBinary, nullable=False))
+    nr_items = db.Column(db.Integer)
+    # Generated memorizations may store only the pseudo random
+    # generator and its seed instead of data, see MemoData.seed_data
+    prng = db.Column(db.Integer)
+    seed = db.Column(db.BigInteger)
     generated = db.Column(db.Boolean, nullable=False)
     state = db.Column(db.Enum(State), nullable=False)
 
@@ -198,6 +222,10 @@ class MemoData(db.Model):
                               cascade="save-update, merge, delete",
                               lazy='dynamic')
 
+    # Tables of memos are paged by (datetime, id), see views._keyset_page
+    __table_args__ = (db.Index('ix_memo_data_user_datetime',
+                               'user_id', 'datetime', 'id'),)
+
     __mapper_args__ = {
         'polymorphic_on': discipline
     }
@@ -217,21 +245,78 @@ class MemoData(db.Model):
         if recall_time < 0:
             raise ValueError(f'recall_time cannot be negative: {recall_time}')
         self.recall_time = recall_time
-        self.data = tuple(data)
+        if data is not None:
+            self.data = tuple(data)
         self.generated = generated
         self.state = state
 
     def __len__(self):
-        return len(self.data)
+        if self.nr_items is None:
+            return len(self.data)
+        return self.nr_items
+
+    # Encoding of data, set by each discipline
+    data_format = None
+    # Data can be generated from a seed, see MemoData.seed_data. A
+    # seedable discipline has a classmethod generate(nr_items,
+    # randbelow) making nr_items with randbelow(n), random int in [0, n).
+    seedable = False
+
+    @property
+    def data(self):
+        """Tuple of items to memorize"""
+        items = self.__dict__.get('_items')
+        if items is None:
+            if self.seed is not None:
+                items = _seeded_data(type(self), self.prng, self.seed,
+                                     self.nr_items)
+            else:
+                items = recall.encoding.unpack_memo(bytes(self._data))
+            self.__dict__['_items'] = items
+        return items
+
+    @data.setter
+    def data(self, data):
+        data = tuple(data)
+        self._data = recall.encoding.pack_memo(data, self.data_format)
+        self.nr_items = len(data)
+        self.prng = self.seed = None
+        self.__dict__['_items'] = data
+
+    def seed_data(self, nr_items, seed=None):
+        """Let data be nr_items generated from a random seed
+
+        Only the seed is stored, the items are generated when first
+        used.
+        """
+        _check_nr_items(nr_items)
+        if seed is None:
+            seed = random.getrandbits(63)
+        self._data = b''
+        self.nr_items = nr_items
+        self.prng = PRNG_SPLITMIX64
+        self.seed = seed
+        self.__dict__.pop('_items', None)
 
     def __repr__(self):
         return f'<{self.__class__.__name__} {self.id}>'
 
     @staticmethod
-    def from_request(request, user):
-        form = request.form
-        ip = request.remote_addr
+    def from_request(request, user, seeded=False):
+        """Create memorization of form in request
+
+        If seeded is True, generated data is stored as a seed if
+        possible.
+        """
+        return MemoData.from_form(request.form, request.remote_addr, user,
+                                  seeded)
 
+    @staticmethod
+    def from_form(form, ip, user, seeded=False):
+        """Create memorization of form, see from_request
+
+        A new language is added to the session but not committed.
+        """
         d = form['discipline'].strip().lower()
         if d == 'base2':
             cls = Base2Data
@@ -256,6 +341,14 @@ class MemoData(db.Model):
 
         memo_time, recall_time = form['time'].strip().split(',')
         memo_time, recall_time = int(memo_time), int(recall_time)
+        data = form.get('data')
+        nr_items = form.get('nr_items')
+        if not (data or nr_items):
+            raise ValueError("data or nr_items must be provided!")
+        generated = data is None
+        if generated:
+            nr_items = int(nr_items)
+            _check_nr_items(nr_items)
         language = form.get('language')
         if language:
             language = language.strip().lower()
@@ -264,18 +357,16 @@ class MemoData(db.Model):
             except sqlalchemy.orm.exc.NoResultFound:
                 language = Language(language=language)
                 db.session.add(language)
-                db.session.commit()
-        data = form.get('data')
-        nr_items = form.get('nr_items')
-        if not (data or nr_items):
-            raise ValueError("data or nr_items must be provided!")
+                db.session.flush()
 
-        generated = data is None
         if generated:
             # If data was not provided, we must generate it ourselves.
             # In order to do so we need to know how many items to
             # generate, + language if words or dates.
-            discipline_data = cls.random(int(nr_items), language)
+            if seeded and cls.seedable:
+                discipline_data = None
+            else:
+                discipline_data = cls.random(nr_items, language)
         else:
             # Parse text data user provided
             discipline_data = cls.from_text(data)
@@ -289,10 +380,24 @@ class MemoData(db.Model):
             generated=generated,
             state=State.private
         )
+        if discipline_data is None:
+            m.seed_data(nr_items)
         m.user = user
         m.language = language
         return m
 
+    # Number of cells in a row scored by _raw_score_digits,
+    # None if the discipline is not scored row by row.
+    row_length = None
+    # Data are small integers compared with MemoData.compare, so the
+    # recall can be corrected with numpy (if installed).
+    vectorized = False
+
+    def compare_version(self):
+        """Version of what compare depends on besides data, a cell
+        by cell result of another version is corrected again"""
+        return None
+
     def compare(self, guess: int, index: int):
         """Check if guess match data at index"""
         if int(guess) == self.data[index]:
@@ -325,8 +430,15 @@ class MemoData(db.Model):
 
         The table can later be saved to disk as .xls file.
         """
+        filedata = io.BytesIO(recall.xls.render(
+            self.xls_table, self.get_xls_header(), self.data, pattern,
+            **kwargs))
+        return filedata
+
+    def get_xls_header(self):
+        """Header of the .xls memorization sheets"""
         # The description include language if available
-        nr_items = len(self.data)
+        nr_items = len(self)
         if self.language:
             description = f'{self.discipline.value}, ' \
                           f'{self.language.language.title()}, {nr_items} st.'
@@ -340,18 +452,9 @@ class MemoData(db.Model):
             memo_time=self.memo_time,
             recall_time=self.recall_time
         )
-        # Create table
-        t = self.xls_table(header=header, pattern=pattern, **kwargs)
-        # Update the table with data
-        for n in self.data:
-            t.add_item(n)
-        # Write xls file to file object
-        filedata = io.BytesIO()
-        t.save(filedata)
-        filedata.seek(0)
-        return filedata
+        return header
 
-    def get_xls_filename(self, pattern, card_colors):
+    def get_xls_filename(self, pattern, card_colors, file_format='xls'):
         """Compute filename of xls file
 
         The filename must map uniquely to the xls content,
@@ -360,10 +463,10 @@ class MemoData(db.Model):
         so it should not be recreated.
         """
         filename_fmt = ('{id}_{discipline}_{memo_time}-{recall_time}min'
-                        '_{language}_{nr}st_p{pattern_str}.xls')
+                        '_{language}_{nr}st_p{pattern_str}.' + file_format)
         if card_colors:
             # Used for Cards
-            filename_fmt = filename_fmt.replace('.xls', '_c.xls')
+            filename_fmt = filename_fmt.replace('.', '_c.')
         filename = filename_fmt.format(
             id=self.id,
             discipline=self.discipline.value.replace(' ', '_'),
@@ -371,7 +474,7 @@ class MemoData(db.Model):
             recall_time=self.recall_time,
             language=self.language.language.replace(' ', '_').title()\
                 if self.language else '',
-            nr=len(self.data),
+            nr=len(self),
             pattern_str=pattern if pattern is not None else ''
         )
         return filename
@@ -396,17 +499,25 @@ class Base2Data(MemoData):
         'polymorphic_identity': Discipline.base2,
     }
     xls_table = staticmethod(recall.xls.get_binary_table)
+    data_format = recall.encoding.MEMO_BITS
+    row_length = 30
+    vectorized = True
+    seedable = True
 
-    @staticmethod
-    def random(nr_items, *args):
-        return tuple(random.randint(0, 1) for _ in range(nr_items))
+    @classmethod
+    def generate(cls, nr_items, randbelow):
+        return tuple(randbelow(2) for _ in range(nr_items))
+
+    @classmethod
+    def random(cls, nr_items, *args):
+        return cls.generate(nr_items, random.randrange)
 
     @staticmethod
     def from_text(text):
         return tuple(int(digit) for digit in re.findall('[01]', text))
 
     def raw_score(self, cbc_r):
-        return self._raw_score_digits(cbc_r, 30)
+        return self._raw_score_digits(cbc_r, self.row_length)
 
 
 class Base10Data(MemoData):
@@ -414,17 +525,25 @@ class Base10Data(MemoData):
         'polymorphic_identity': Discipline.base10,
     }
     xls_table = staticmethod(recall.xls.get_decimal_table)
+    data_format = recall.encoding.MEMO_NIBBLES
+    row_length = 40
+    vectorized = True
+    seedable = True
 
-    @staticmethod
-    def random(nr_items, *args):
-        return tuple(random.randint(0, 9) for _ in range(nr_items))
+    @classmethod
+    def generate(cls, nr_items, randbelow):
+        return tuple(randbelow(10) for _ in range(nr_items))
+
+    @classmethod
+    def random(cls, nr_items, *args):
+        return cls.generate(nr_items, random.randrange)
 
     @staticmethod
     def from_text(text):
         return tuple(int(digit) for digit in re.findall('\d', text))
 
     def raw_score(self, cbc_r):
-        return self._raw_score_digits(cbc_r, 40)
+        return self._raw_score_digits(cbc_r, self.row_length)
 
 
 class SpokenData(MemoData):
@@ -432,10 +551,17 @@ class SpokenData(MemoData):
         'polymorphic_identity': Discipline.spoken,
     }
     xls_table = staticmethod(recall.xls.get_decimal_table)
+    data_format = recall.encoding.MEMO_NIBBLES
+    vectorized = True
+    seedable = True
 
-    @staticmethod
-    def random(nr_items, *args):
-        return tuple(random.randint(0, 9) for _ in range(nr_items))
+    @classmethod
+    def generate(cls, nr_items, randbelow):
+        return tuple(randbelow(10) for _ in range(nr_items))
+
+    @classmethod
+    def random(cls, nr_items, *args):
+        return cls.generate(nr_items, random.randrange)
 
     @staticmethod
     def from_text(text):
@@ -477,13 +603,13 @@ class WordsData(MemoData):
         'polymorphic_identity': Discipline.words,
     }
     xls_table = staticmethod(recall.xls.get_words_table)
+    data_format = recall.encoding.MEMO_TEXT
+    row_length = 20
 
     @staticmethod
     def random(nr_items, language):
-        words = [w.word for w in language.words]
-        random.shuffle(words)
-        data = tuple(words[0:nr_items])
-        return data
+        words = Word.pool(language.id).texts
+        return tuple(random.sample(words, min(nr_items, len(words))))
 
     @staticmethod
     def from_text(text):
@@ -507,19 +633,16 @@ class WordsData(MemoData):
         else:
             return Item.wrong
 
+    def compare_version(self):
+        return CacheVersion.get(f'almost_correct:{self.user_id}')
+
     def _word_almost_correct(self, guess: str, index: int):
-        if not hasattr(self, '_almost_correct_word_lookup'):
-            mappings = self.user.almost_correct_words.all()
-            self._almost_correct_word_lookup = mappings
-        for m in self._almost_correct_word_lookup:
-            if m.word == self.data[index] and m.language == self.language:
-                if m.almost_correct == guess:
-                    return True
-        return False
+        lookup = AlmostCorrectWord.lookup(self.user_id, self.language_id)
+        return guess in lookup.get(self.data[index], ())
 
     def raw_score(self, cbc_r):
         """Calculate raw score"""
-        return self._raw_score_digits(cbc_r, 20)
+        return self._raw_score_digits(cbc_r, self.row_length)
 
 
 class InvalidHistoricalDate(Exception):
@@ -550,6 +673,7 @@ class DatesData(MemoData):
         'polymorphic_identity': Discipline.dates,
     }
     xls_table = staticmethod(recall.xls.get_dates_table)
+    data_format = recall.encoding.MEMO_DATES
 
     @property
     def lookup(self):
@@ -560,10 +684,9 @@ class DatesData(MemoData):
 
     @staticmethod
     def random(nr_items, language):
-        stories = [s.story for s in language.stories]
+        stories = Story.pool(language.id).texts
         nr_items = min(nr_items, len(stories))
-        random.shuffle(stories)
-        stories = stories[0:nr_items]
+        stories = random.sample(stories, nr_items)
         dates = random.sample(range(1000, 2100), len(stories))
         recall_order = list(range(nr_items))
         random.shuffle(recall_order)
@@ -664,18 +787,29 @@ class CardData(MemoData):
         'polymorphic_identity': Discipline.cards,
     }
     xls_table = staticmethod(recall.xls.get_card_table)
+    data_format = recall.encoding.MEMO_BYTES
+    row_length = NR_CARDS_IN_DECK
+    vectorized = True
+    seedable = True
 
-    @staticmethod
-    def random(nr_items, *args):
+    @classmethod
+    def generate(cls, nr_items, randbelow):
         """Create tuple with nr_items card-integers"""
         def get_card():
             cards = list(range(NR_CARDS_IN_DECK))
             while True:
-                random.shuffle(cards)
+                # Fisher-Yates shuffle
+                for i in reversed(range(1, len(cards))):
+                    j = randbelow(i + 1)
+                    cards[i], cards[j] = cards[j], cards[i]
                 yield from cards
 
         return tuple(c for c in itertools.islice(get_card(), nr_items))
 
+    @classmethod
+    def random(cls, nr_items, *args):
+        return cls.generate(nr_items, random.randrange)
+
     @staticmethod
     def from_text(text):
         """Parse card-integers from a text"""
@@ -687,7 +821,218 @@ class CardData(MemoData):
         return cards
 
     def raw_score(self, cbc_r):
-        return self._raw_score_digits(cbc_r, NR_CARDS_IN_DECK)
+        return self._raw_score_digits(cbc_r, self.row_length)
+
+
+def _check_nr_items(nr_items):
+    if not 0 < nr_items <= MAX_NR_ITEMS:
+        raise ValueError(f'Number of items must be 1 to {MAX_NR_ITEMS}, '
+                         f'not {nr_items}')
+
+
+def _splitmix64(seed):
+    """Yield pseudo random 64 bit integers, SplitMix64 of seed"""
+    state = seed
+    while True:
+        state = (state + 0x9E3779B97F4A7C15) & MASK64
+        z = state
+        z = ((z ^ (z >> 30))*0xBF58476D1CE4E5B9) & MASK64
+        z = ((z ^ (z >> 27))*0x94D049BB133111EB) & MASK64
+        yield z ^ (z >> 31)
+
+
+@functools.lru_cache(maxsize=32)
+def _seeded_data(cls, prng, seed, nr_items):
+    """Generate the data of a seeded memorization"""
+    if prng != PRNG_SPLITMIX64:
+        raise ValueError(f'Unknown pseudo random generator: {prng}')
+    numbers = _splitmix64(seed)
+
+    def randbelow(n):
+        # Reject the top numbers so all results are equally likely
+        limit = MASK64 + 1 - (MASK64 + 1) % n
+        while True:
+            x = next(numbers)
+            if x < limit:
+                return x % n
+
+    return cls.generate(nr_items, randbelow)
+
+
+MAX_INCREMENTAL_CORRECTIONS = 256
+
+# Recall cell values in vectorized correction
+EMPTY = -1
+WRONG = -2
+ITEMS = {item.value: item for item in Item}
+
+
+class IncrementalCorrection:
+    """Cell by cell correction of a recall which can be updated
+
+    The cell by cell result of the previous correction is kept
+    together with the number of correct (and almost correct) cells of
+    each row. When cells of the recall change, only those cells are
+    compared again and only their rows are scored again. The result is
+    not reused after MemoData.compare_version changes, such as when
+    almost correct words are added.
+    """
+
+    def __init__(self, recall):
+        memo = recall.memo
+        self.memo_id = memo.id
+        self.compare_version = memo.compare_version()
+        self.seq = recall.seq
+        self.nr_items = len(memo.data)
+        self.row_length = memo.row_length
+        self.data = list(recall.data)
+        if numpy is not None and memo.vectorized:
+            try:
+                self._correct_vectorized(memo)
+                return
+            except OverflowError:
+                # A guess with more digits than int64 holds, compared
+                # as a Python int cell by cell
+                pass
+        self.start_of_emptiness = recall.start_of_emptiness
+        self.cbc_r = recall._correct_cells()
+        if self.row_length is not None:
+            nr_rows = math.ceil(len(self.cbc_r)/self.row_length)
+            self.row_correct = [0]*nr_rows
+            self.row_hits = [0]*nr_rows
+            for i, item in enumerate(self.cbc_r):
+                self._count(i, item, 1)
+            # Score of each row as if it is complete, in half points
+            self.row_halves = [self._row_halves(r, self.row_length)
+                               for r in range(nr_rows)]
+            self.halves = sum(self.row_halves)
+
+    def _correct_vectorized(self, memo):
+        """Correct all cells and score all rows with numpy arrays"""
+        nr_cells = len(self.data)
+        n = min(self.nr_items, nr_cells)
+        solution = numpy.array(memo.data[0:n], dtype=numpy.int8)
+        cells = numpy.array(self.data[0:n], dtype=str)
+        filled = numpy.char.strip(cells) != ''
+        # Empty cells are EMPTY, guesses that can't be data are WRONG
+        guesses = cells[filled].astype(numpy.int64)  # ValueError as int()
+        recalled = numpy.full(n, EMPTY, dtype=numpy.int8)
+        recalled[filled] = numpy.where(
+            (0 <= guesses) & (guesses <= 127), guesses, WRONG)
+        filled_indices = numpy.flatnonzero(filled)
+        if len(filled_indices) > 0:
+            self.start_of_emptiness = int(filled_indices[-1]) + 1
+        else:
+            self.start_of_emptiness = 0
+
+        codes = numpy.full(nr_cells, Item.off_limits.value, dtype=numpy.int8)
+        codes[0:n] = numpy.where(
+            filled,
+            numpy.where(recalled == solution,
+                        Item.correct.value, Item.wrong.value),
+            numpy.where(numpy.arange(n) < self.start_of_emptiness,
+                        Item.gap.value, Item.not_reached.value))
+        self.cbc_r = [ITEMS[code] for code in codes.tolist()]
+
+        if self.row_length is not None:
+            length = self.row_length
+            nr_rows = math.ceil(nr_cells/length)
+            rows = numpy.full(nr_rows*length, Item.off_limits.value,
+                              dtype=numpy.int8)
+            rows[0:nr_cells] = codes
+            rows = rows.reshape(nr_rows, length)
+            row_correct = (rows == Item.correct.value).sum(axis=1)
+            row_hits = row_correct + (
+                rows == Item.almost_correct.value).sum(axis=1)
+            row_halves = numpy.where(
+                row_hits == length, 2*row_correct,
+                numpy.where(row_hits == length - 1, row_correct, 0))
+            self.row_correct = row_correct.tolist()
+            self.row_hits = row_hits.tolist()
+            self.row_halves = row_halves.tolist()
+            self.halves = sum(self.row_halves)
+
+    def applies_to(self, recall):
+        return (self.memo_id == recall.memo_id
+                and len(self.data) == len(recall.data)
+                and self.compare_version == recall.memo.compare_version())
+
+    def changed_cells(self, data):
+        """Indices of cells in data that differ from corrected data"""
+        return [i for i, (old, new) in enumerate(zip(self.data, data))
+                if old != new]
+
+    def update(self, recall, changed):
+        """Correct the changed cells of recall again"""
+        memo = recall.memo
+        old_start = self.start_of_emptiness
+        start = old_start
+        for i in changed:
+            self.data[i] = recall.data[i]
+            if self.data[i] and i < self.nr_items:
+                start = max(start, i + 1)
+        while start > 0 and not self.data[start - 1]:
+            start -= 1
+        self.start_of_emptiness = start
+
+        # Empty cells between the old and the new start of emptiness
+        # switch between gap and not reached.
+        cells = set(changed)
+        cells.update(range(min(start, old_start), max(start, old_start)))
+        rows = set()
+        for i in cells:
+            item = RecallData._correct_cell(memo, i, self.data[i],
+                                            self.nr_items, start)
+            if item == self.cbc_r[i]:
+                continue
+            if self.row_length is not None:
+                self._count(i, self.cbc_r[i], -1)
+                self._count(i, item, 1)
+                rows.add(i//self.row_length)
+            self.cbc_r[i] = item
+        for r in rows:
+            halves = self._row_halves(r, self.row_length)
+            self.halves += halves - self.row_halves[r]
+            self.row_halves[r] = halves
+        self.seq = recall.seq
+
+    def raw_score(self, memo):
+        if self.row_length is None:
+            return memo.raw_score(self.cbc_r[0:self.start_of_emptiness])
+        if self.start_of_emptiness == 0:
+            return 0
+        # The last row before the emptiness is scored by the
+        # number of cells it has before the emptiness. Rows after
+        # it only have empty cells and no score.
+        last = (self.start_of_emptiness - 1)//self.row_length
+        length = self.start_of_emptiness - last*self.row_length
+        halves = (self.halves - self.row_halves[last]
+                  + self._row_halves(last, length))
+        return math.ceil(halves/2)
+
+    def _count(self, i, item, n):
+        r = i//self.row_length
+        if item == Item.correct:
+            self.row_correct[r] += n
+            self.row_hits[r] += n
+        elif item == Item.almost_correct:
+            self.row_hits[r] += n
+
+    def _row_halves(self, r, length):
+        """Score of row r of given length, see _raw_score_digits"""
+        if self.row_hits[r] == length:
+            return 2*self.row_correct[r]
+        elif self.row_hits[r] == length - 1:
+            return self.row_correct[r]
+        return 0
+
+
+_incremental_corrections = collections.OrderedDict()
+
+
+class RecallOutOfSync(Exception):
+    """Delta of recall cells does not apply to the stored recall"""
+    pass
 
 
 class RecallData(db.Model):
@@ -696,24 +1041,49 @@ class RecallData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     datetime = db.Column(db.DateTime, nullable=False)
     ip = db.Column(db.String(40), nullable=False)
-    data = db.Column(db.PickleType, nullable=False)
+    data = db.Column(recall.encoding.RecallCells, nullable=False)
     time_remaining = db.Column(db.Float, nullable=False)
     locked = db.Column(db.Boolean, nullable=False)
+    # Sequence number of last accepted submit of recall cells, 0 for
+    # recalls stored before it was counted
+    seq = db.Column(db.Integer, nullable=False, server_default='0')
+    # Digest of data, to recognize unchanged autosaves
+    digest = db.Column(db.String(32))
 
     # ForeignKeys
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     memo_id = db.Column(db.Integer, db.ForeignKey('memo_data.id'), nullable=False)
 
+    # A user has one recall of each memorization
+    __table_args__ = (db.UniqueConstraint('memo_id', 'user_id',
+                                          name='uq_recall_data_memo_user'),
+                      db.Index('ix_recall_data_datetime', 'datetime', 'id'))
+
     # Relationships
     correction = db.relationship('Correction', backref='recall',
                                  cascade="save-update, merge, delete",
                                  uselist=False)
 
     def __init__(self, request):
-        form = request.form
+        self.seq = 0
+        self.update(request)
 
+    def update(self, request):
+        """Replace all recall cells with the ones in request form"""
+        form = request.form
         self.datetime = datetime.utcnow()
         self.ip = request.remote_addr
+        self.data = self.cells_from_form(form)
+        self.digest = self.digest_cells(self.data)
+        self.time_remaining = float(form['seconds_remaining'])
+        self.locked = False
+        self.seq += 1
+        # Cached value depend on data
+        self.__dict__.pop('_start_of_emptiness', None)
+
+    @staticmethod
+    def cells_from_form(form):
+        """Get all recall cells r_0, r_1, ... of form"""
         data = list()
         for i in range(len(form)):
             try:
@@ -722,9 +1092,42 @@ class RecallData(db.Model):
                 break
             else:
                 data.append(recall_cell)
-        self.data = data
-        self.time_remaining = float(form['seconds_remaining'])
-        self.locked = False
+        return data
+
+    @staticmethod
+    def digest_cells(data):
+        """Get digest of recall cells"""
+        return hashlib.blake2b('\x00'.join(data).encode(),
+                               digest_size=16).hexdigest()
+
+    @staticmethod
+    def patch_cells(data, seq, form):
+        """Apply delta of recall cells in form to data
+
+        The form only contains the cells changed since the submit
+        with sequence number form['seq']. If that is not seq, the
+        sequence number of data, the delta can't be applied and the
+        client must send the full recall again.
+
+        Returns the new recall cells and the indices of the
+        changed cells.
+        """
+        if int(form['seq']) != seq:
+            raise RecallOutOfSync(
+                f'Delta based on seq {form["seq"]}, stored seq {seq}')
+        data = list(data)
+        changed = list()
+        for key, value in form.items():
+            match = re.fullmatch(r'r_(\d+)', key)
+            if match is None:
+                continue
+            i = int(match.group(1))
+            if i >= len(data):
+                raise RecallOutOfSync(f'Cell {i} outside recall of '
+                                      f'{len(data)} cells')
+            data[i] = value.strip()
+            changed.append(i)
+        return data, changed
 
     @property
     def start_of_emptiness(self):
@@ -737,27 +1140,46 @@ class RecallData(db.Model):
         return self._start_of_emptiness
 
     def _correct_cells(self):
-        result = [None]*len(self.data)
         nr_items = len(self.memo.data)
-        for i, user_value in enumerate(self.data, start=0):
-            if i >= nr_items:
-                result[i] = Item.off_limits
+        return [self._correct_cell(self.memo, i, user_value, nr_items,
+                                   self.start_of_emptiness)
+                for i, user_value in enumerate(self.data)]
+
+    @staticmethod
+    def _correct_cell(memo, i, user_value, nr_items, start_of_emptiness):
+        if i >= nr_items:
+            return Item.off_limits
+        elif not user_value.strip():
+            # Empty cell
+            if i < start_of_emptiness:
+                return Item.gap
             else:
-                if not user_value.strip():
-                    # Empty cell
-                    if i < self.start_of_emptiness:
-                        result[i] = Item.gap
-                    else:
-                        result[i] = Item.not_reached
-                else:
-                    result[i] = self.memo.compare(user_value, i)
-        return result
-
-    def correct(self):
-        cbc_r = self._correct_cells()
-        raw_score = self.memo.raw_score(cbc_r[0:self.start_of_emptiness])
+                return Item.not_reached
+        else:
+            return memo.compare(user_value, i)
+
+    def correct(self, changed=None, incremental=True):
+        """Correct recall
+
+        If incremental is True, the correction of the previous submit
+        of this recall is reused if available and only the changed
+        cells are corrected again. changed is the indices of the
+        cells changed since the previous submit, if known.
+        """
+        correction = _incremental_corrections.pop(self.id, None)
+        if not (incremental and correction and correction.applies_to(self)):
+            correction = IncrementalCorrection(self)
+        else:
+            if changed is None or correction.seq != self.seq - 1:
+                changed = correction.changed_cells(self.data)
+            correction.update(self, changed)
+        if self.id is not None:
+            _incremental_corrections[self.id] = correction
+            while len(_incremental_corrections) > MAX_INCREMENTAL_CORRECTIONS:
+                _incremental_corrections.popitem(last=False)
+        raw_score = correction.raw_score(self.memo)
         points = self.memo.points(raw_score)
-        return raw_score, points, cbc_r
+        return raw_score, points, list(correction.cbc_r)
 
     def __repr__(self):
         return f'<RecallData of {self.memo_id}>'
@@ -776,7 +1198,11 @@ class Correction(db.Model):
 
     raw_score = db.Column(db.Float, nullable=False)
     points = db.Column(db.Float, nullable=False)
-    cell_by_cell = db.Column(db.PickleType)
+    # Item values of the cells, see recall.encoding.pack_items. Only
+    # loaded when the cell by cell result is needed.
+    _cell_by_cell = db.deferred(db.Column('cell_by_cell', db.LargeBinary))
+    # The RecallData.seq that was corrected
+    seq = db.Column(db.Integer)
 
     # ForeignKeys
     recall_id = db.Column(db.Integer, db.ForeignKey('recall_data.id'))
@@ -802,6 +1228,21 @@ class Correction(db.Model):
         self.points = points
         self.cell_by_cell = cell_by_cell
 
+    @property
+    def cell_by_cell(self):
+        """Item of each recall cell"""
+        return [ITEMS[code] for code in self._cell_codes()]
+
+    @cell_by_cell.setter
+    def cell_by_cell(self, cell_by_cell):
+        self._cell_by_cell = recall.encoding.pack_items(
+            [item.value for item in cell_by_cell])
+
+    def _cell_codes(self):
+        if self._cell_by_cell is None:
+            return []
+        return recall.encoding.unpack_items(bytes(self._cell_by_cell))
+
     def __iter__(self):
         """Used for template access"""
         yield from (
@@ -814,7 +1255,7 @@ class Correction(db.Model):
             ('consecutive', self.consecutive),
             ('raw_score', self.raw_score),
             ('points', self.points),
-            ('cell_by_cell', [i.name for i in self.cell_by_cell])
+            ('cell_by_cell', [ITEMS[code].name for code in self._cell_codes()])
         )
 
     def __repr__(self):
@@ -876,6 +1317,58 @@ class AlmostCorrectWord(db.Model):
     def __repr__(self):
         return f'<{self.word} ~= {self.almost_correct}>'
 
+    @staticmethod
+    def lookup(user_id, language_id):
+        """Get almost correct words of user and language
+
+        The mapping word -> set of almost correct words is read in
+        one query and cached in the process until invalidate is
+        called, in any process.
+        """
+        key = (user_id, language_id)
+        version = CacheVersion.get(f'almost_correct:{user_id}')
+        cached = _almost_correct_lookups.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        lookup = dict()
+        rows = db.session.query(
+            AlmostCorrectWord.word, AlmostCorrectWord.almost_correct
+        ).filter_by(user_id=user_id, language_id=language_id)
+        for word, almost_correct in rows:
+            lookup.setdefault(word, set()).add(almost_correct)
+        _almost_correct_lookups[key] = (version, lookup)
+        return lookup
+
+    @staticmethod
+    def invalidate(user_id):
+        """Make every process read the lookups of user again, commits"""
+        CacheVersion.increase(f'almost_correct:{user_id}')
+
+
+# (user_id, language_id) -> version, lookup
+_almost_correct_lookups = dict()
+
+
+# Texts of the words or stories of a language, cached in each process
+# at version of CacheVersion word or story
+VocabularyPool = collections.namedtuple('VocabularyPool',
+                                        ['version', 'texts'])
+
+
+def _vocabulary_pool(text_column, language_id):
+    key = (text_column.key, language_id)
+    version = CacheVersion.get(text_column.key)
+    pool = _vocabulary_pools.get(key)
+    if pool is not None and pool.version == version:
+        return pool
+    rows = db.session.query(text_column).filter_by(language_id=language_id)
+    pool = VocabularyPool(version, tuple(row[0] for row in rows))
+    _vocabulary_pools[key] = pool
+    return pool
+
+
+_vocabulary_pools = dict()
+
 
 class Word(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -909,6 +1402,16 @@ class Word(db.Model):
     def __repr__(self):
         return f'<Word {self.word}>'
 
+    @staticmethod
+    def pool(language_id):
+        """Get cached VocabularyPool of the words of language"""
+        return _vocabulary_pool(Word.word, language_id)
+
+    @staticmethod
+    def invalidate_pool():
+        """Make every process read the words again, commits"""
+        CacheVersion.increase(Word.word.key)
+
 
 class Story(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -940,3 +1443,50 @@ class Story(db.Model):
 
     def __repr__(self):
         return f'<Story "{self.story}">'
+
+    @staticmethod
+    def pool(language_id):
+        """Get cached VocabularyPool of the stories of language"""
+        return _vocabulary_pool(Story.story, language_id)
+
+    @staticmethod
+    def invalidate_pool():
+        """Make every process read the stories again, commits"""
+        CacheVersion.increase(Story.story.key)
+
+
+class CacheVersion(db.Model):
+    """Version of data cached in the memory of each process
+
+    The processes of the application don't share memory, a process
+    changing the data increases the version in the database, and each
+    process compares it with the version of its cache, at most once
+    per request or correction job.
+    """
+    name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+
+    @staticmethod
+    def get(name):
+        """Current version of cached data name"""
+        versions = (flask.g.setdefault('cache_versions', dict())
+                    if flask.has_app_context() else dict())
+        if name not in versions:
+            versions[name] = db.session.query(CacheVersion.version).filter_by(
+                name=name).scalar() or 0
+        return versions[name]
+
+    @staticmethod
+    def increase(name):
+        """Make every process read cached data name again, commits"""
+        updated = CacheVersion.query.filter_by(name=name).update(
+            {CacheVersion.version: CacheVersion.version + 1})
+        if not updated:
+            db.session.add(CacheVersion(name, 1))
+        db.session.commit()
+        if flask.has_app_context():
+            flask.g.pop('cache_versions', None)
@@ -0,0 +1,68 @@
+"""Spread autosaves of competitors evenly over time
+
+When a competition starts, all competitors start their recall at the
+same moment, and with a fixed autosave interval all their autosaves
+would keep arriving in the same few seconds. Instead the server tells
+each client when to send its next autosave.
+
+Time is divided into slots. A client is given the least loaded slot
+around one AUTOSAVE_INTERVAL from now. A slot is full when it holds
+AUTOSAVE_CAPACITY autosaves per second of slot length. If all slots
+around the interval are full the server is overloaded, and the
+client is given a later slot, up to AUTOSAVE_MAX_INTERVAL from now.
+"""
+import math
+import random
+import threading
+import time
+
+from recall import app, metrics
+
+
+class AutosaveScheduler:
+
+    def __init__(self, interval, max_interval, capacity, slot_length=0.5):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.slot_length = slot_length
+        self.slot_capacity = max(1, int(capacity*slot_length))
+        # Slot number -> nr of autosaves given that slot
+        self.slots = dict()
+        self.lock = threading.Lock()
+
+    def next_delay(self, now=None):
+        """Get seconds until the next autosave of a client"""
+        if now is None:
+            now = time.time()
+        current = math.floor(now/self.slot_length)
+        # Slots around one interval from now, least loaded wins.
+        # Ties are won by the slot closest to the interval.
+        target = math.floor((now + self.interval)/self.slot_length)
+        spread = max(1, round(self.interval/self.slot_length/2))
+        last = math.floor((now + self.max_interval)/self.slot_length)
+        with self.lock:
+            for slot in [s for s in self.slots if s <= current]:
+                del self.slots[slot]
+            candidates = range(max(current + 1, target - spread),
+                               min(last, target + spread) + 1)
+            slot = min(candidates, key=lambda s: (self.slots.get(s, 0),
+                                                  abs(s - target)))
+            if self.slots.get(slot, 0) >= self.slot_capacity:
+                # Overloaded, back off to first later slot with room
+                metrics.incr('autosave.backoff')
+                slot = target + spread + 1
+                while (slot < last
+                       and self.slots.get(slot, 0) >= self.slot_capacity):
+                    slot += 1
+                slot = min(slot, last)
+            self.slots[slot] = self.slots.get(slot, 0) + 1
+        # Anywhere within the slot
+        start = (slot + random.random())*self.slot_length
+        return max(0.0, start - now)
+
+
+scheduler = AutosaveScheduler(
+    interval=app.config['AUTOSAVE_INTERVAL'],
+    max_interval=app.config['AUTOSAVE_MAX_INTERVAL'],
+    capacity=app.config['AUTOSAVE_CAPACITY'],
+)
@@ -0,0 +1,331 @@
+"""Render memorization sheets to the xls cache
+
+A rendered sheet is kept in the xls directory, named by the id of its
+memorization and a digest of everything the sheet is built from: the
+stored memorization data (or its seed), the header, the pattern and
+card_colors, with the extension of its format (xls or xlsx). The same
+sheet is rendered only once, and a changed memorization never gets an
+outdated sheet. The user downloads it under the name given by
+MemoData.get_xls_filename.
+
+A sheet is written to a temporary file and renamed, and rendering
+holds one of LOCK_STRIPES lock files of the directory, so concurrent
+requests for a missing sheet, in any process, render it once.
+
+The cache is bounded by XLS_CACHE_BYTES. When a new sheet makes it
+larger, the least recently used sheets are removed, a hit counts as
+a use. The sheets of a deleted memorization are removed at once.
+
+Building a large sheet is CPU bound, so several sheets are rendered
+in parallel in a pool of XLS_PROCESSES processes. They are forked from
+a fresh server process, not from the application, whose threads may
+hold locks a forked child would inherit, so the items, the header and
+the xls table function are pickled to them.
+
+When a memorization is created, the sheet with the owner's pattern
+settings is pre-rendered in the pool, so the first download finds it
+done, or waits for the render in progress instead of starting another.
+The metrics xls.pending (renders queued or running), xls.rendered and
+xls.render_ms (time spent rendering) show how the pool keeps up, and
+xls.hit, xls.evicted and xls.purged how the cache is used.
+
+bundle streams a ZIP archive of many sheets, adding each as soon as it
+is rendered, with at most CHUNK_SIZE bytes of the archive in memory.
+"""
+import atexit
+import concurrent.futures
+import fcntl
+import glob
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import zipfile
+
+from recall import app, metrics
+from recall import models
+import recall.xls
+
+LOCK_STRIPES = 16
+CHUNK_SIZE = 64*1024
+# Seconds a sheet is kept after a use, even if the cache is full, so
+# it is not removed before it is sent
+MIN_AGE = 60
+
+_pool = None
+# Filename -> Future of renders in the pool
+_pending = dict()
+_pending_lock = threading.Lock()
+
+# Pattern setting of the owner, used when pre-rendering
+PATTERN_SETTINGS = {
+    models.Discipline.base2: 'pattern_binary',
+    models.Discipline.base10: 'pattern_decimals',
+    models.Discipline.words: 'pattern_words',
+    models.Discipline.dates: 'pattern_dates',
+    models.Discipline.cards: 'pattern_cards',
+}
+
+
+def path(filename):
+    return os.path.join(app.root_path, 'xls', filename)
+
+
+def cache_filename(memo, pattern, card_colors, file_format='xls'):
+    """Name of the sheet of memo in the cache"""
+    header = memo.get_xls_header()
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (memo.discipline.name, header.title, header.description,
+                 header.memo_time, header.recall_time, pattern or '',
+                 card_colors and memo.discipline == models.Discipline.cards):
+        digest.update(f'{part}\x00'.encode('utf-8'))
+    if memo.seed is not None:
+        digest.update(f'{memo.prng}:{memo.seed}:{len(memo)}'.encode('utf-8'))
+    else:
+        digest.update(bytes(memo._data))
+    return f'{memo.id}_{digest.hexdigest()}.{file_format}'
+
+
+def _pool_executor():
+    global _pool
+    if _pool is None:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['recall.xls'])
+        if not os.path.basename(sys.executable).startswith('python'):
+            # Embedded interpreter, the executable is uWSGI
+            context.set_executable(
+                os.path.join(sys.exec_prefix, 'bin', 'python3'))
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=app.config['XLS_PROCESSES'], mp_context=context)
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def _render_args(memo, pattern, card_colors, file_format):
+    kwargs = dict(file_format=file_format)
+    if memo.discipline == models.Discipline.cards:
+        kwargs['card_colors'] = card_colors
+    return (memo.xls_table, memo.get_xls_header(), memo.data, pattern), kwargs
+
+
+def _render_timed(path, *args, **kwargs):
+    """Render file unless it exists, return seconds spent or None"""
+    stripe = int(hashlib.md5(path.encode('utf-8')).hexdigest(), 16)
+    lock_path = os.path.join(os.path.dirname(path),
+                             f'.lock{stripe % LOCK_STRIPES}')
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isfile(path):
+            # Rendered by someone else while we waited
+            return None
+        start = time.perf_counter()
+        recall.xls.render_file(path, *args, **kwargs)
+        return time.perf_counter() - start
+
+
+def _count_render(seconds):
+    if seconds is not None:
+        metrics.incr('xls.rendered')
+        metrics.incr('xls.render_ms', round(1000*seconds))
+        evict()
+
+
+def _rendered(filename, future):
+    with _pending_lock:
+        _pending.pop(filename, None)
+    metrics.incr('xls.pending', -1)
+    if future.exception() is not None:
+        app.logger.error(f'Failed to render {filename}: {future.exception()}')
+        metrics.incr('xls.failed')
+        return
+    _count_render(future.result())
+
+
+def _hit(filename):
+    """Mark sheet as used if it is cached, return True if it is"""
+    try:
+        os.utime(path(filename))
+    except FileNotFoundError:
+        return False
+    metrics.incr('xls.hit')
+    return True
+
+
+def _submit(memo, pattern, card_colors, file_format='xls'):
+    """Render sheet in the pool unless it exists, return filename, Future
+
+    The Future is None if the sheet exists.
+    """
+    filename = cache_filename(memo, pattern, card_colors, file_format)
+    with _pending_lock:
+        future = _pending.get(filename)
+        if future is not None or _hit(filename):
+            return filename, future
+        args, kwargs = _render_args(memo, pattern, card_colors, file_format)
+        future = _pool_executor().submit(
+            _render_timed, path(filename), *args, **kwargs)
+        _pending[filename] = future
+    metrics.incr('xls.pending')
+    future.add_done_callback(lambda f: _rendered(filename, f))
+    return filename, future
+
+
+def render(memo, pattern, card_colors=False, file_format='xls'):
+    """Render sheet of memo if not cached already, return filename
+
+    If the sheet is being rendered in the pool, wait for it.
+    """
+    filename = cache_filename(memo, pattern, card_colors, file_format)
+    with _pending_lock:
+        future = _pending.get(filename)
+    if future is not None:
+        # Wait for the render in progress, and render again if it failed
+        concurrent.futures.wait([future])
+    if not _hit(filename):
+        args, kwargs = _render_args(memo, pattern, card_colors, file_format)
+        _count_render(_render_timed(path(filename), *args, **kwargs))
+    return filename
+
+
+def render_many(jobs):
+    """Render sheets of (memo, pattern, card_colors) jobs in parallel
+
+    Returns the filenames in the order of jobs.
+    """
+    filenames = list()
+    futures = list()
+    for memo, pattern, card_colors in jobs:
+        filename, future = _submit(memo, pattern, card_colors)
+        filenames.append(filename)
+        if future is not None:
+            futures.append(future)
+    for future in futures:
+        future.result()
+    return filenames
+
+
+def settings_pattern(memo, settings):
+    """Pattern and card_colors of memo in the pattern settings of a user
+
+    None if memo has no sheet, or the pattern is invalid.
+    """
+    key = PATTERN_SETTINGS.get(memo.discipline)
+    if key is None:
+        return None
+    try:
+        pattern = recall.xls.verify_and_clean_pattern(
+            settings.get(key) or '')
+    except ValueError:
+        return None
+    card_colors = (memo.discipline == models.Discipline.cards
+                   and settings.get('card_colors') is True)
+    return pattern, card_colors
+
+
+def prerender(memo, settings):
+    """Start rendering sheet of memo with the pattern settings"""
+    if not app.config['XLS_PRERENDER']:
+        return
+    sheet = settings_pattern(memo, settings)
+    if sheet is not None:
+        _submit(memo, *sheet)
+
+
+class _ChunkStream:
+    """Unseekable file keeping what is written until taken"""
+
+    def __init__(self):
+        self.chunks = list()
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def bundle(jobs):
+    """Yield ZIP archive of sheets of (memo, pattern, card_colors,
+    file_format, name) jobs, in the order they are rendered
+
+    Sheets in the cache are added first, the others are rendered in
+    the pool meanwhile. name is the name of the sheet in the archive.
+    """
+    ready = list()
+    rendering = dict()
+    for memo, pattern, card_colors, file_format, name in jobs:
+        _, future = _submit(memo, pattern, card_colors, file_format)
+        job = (memo, pattern, card_colors, file_format, name)
+        if future is None:
+            ready.append(job)
+        else:
+            rendering.setdefault(future, list()).append(job)
+
+    def jobs_in_order():
+        yield from ready
+        for future in concurrent.futures.as_completed(rendering):
+            yield from rendering[future]
+
+    stream = _ChunkStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for memo, pattern, card_colors, file_format, name in jobs_in_order():
+            # Renders again if evicted, or if the render failed
+            filename = render(memo, pattern, card_colors, file_format)
+            with open(path(filename), 'rb') as sheet, \
+                    archive.open(name, 'w') as member:
+                for chunk in iter(lambda: sheet.read(CHUNK_SIZE), b''):
+                    member.write(chunk)
+                    yield stream.take()
+            yield stream.take()
+    yield stream.take()
+
+
+def evict():
+    """Remove least recently used sheets until within XLS_CACHE_BYTES"""
+    budget = app.config['XLS_CACHE_BYTES']
+    entries = list()
+    total = 0
+    with os.scandir(path('')) as it:
+        for entry in it:
+            if entry.name.endswith(('.xls', '.xlsx')) and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= budget:
+        return
+    entries.sort()
+    keep_after = time.time() - MIN_AGE
+    for mtime, size, entry_path in entries:
+        if total <= budget or mtime > keep_after:
+            break
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        metrics.incr('xls.evicted')
+
+
+def purge(memo_ids):
+    """Remove the sheets of deleted memorizations
+
+    Sheets being rendered are left, their temporary files are renamed
+    at the end of the render.
+    """
+    for memo_id in memo_ids:
+        for filename in glob.glob(path(f'{memo_id}_*.xls*')):
+            if not filename.endswith(('.xls', '.xlsx')):
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                continue
+            metrics.incr('xls.purged')
@@ -0,0 +1,82 @@
+"""Data cached in each process, read again when another process changes it
+
+Run from the repository root: python -m pytest recall/test/test_cache.py
+"""
+import pytest
+
+from recall import app, db
+from recall import models
+from recall.test.test_views import client, add_user
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    """Each test has a new database, with versions from 0 again"""
+    models._vocabulary_pools.clear()
+    models._almost_correct_lookups.clear()
+
+
+def add_word(language, word):
+    word = models.Word('127.0.0.1', 'owner', word,
+                       models.WordClass.concrete_noun)
+    word.language = language
+    db.session.add(word)
+    db.session.commit()
+
+
+def words(language):
+    with app.app_context():
+        return models.Word.pool(language.id).texts
+
+
+def increase_in_other_process(name):
+    table = models.CacheVersion.__table__
+    if not db.session.execute(table.update().where(table.c.name == name)
+                              .values(version=table.c.version + 1)).rowcount:
+        db.session.execute(table.insert().values(name=name, version=1))
+    db.session.commit()
+
+
+def test_word_pool(client):
+    language = models.Language('swedish')
+    add_word(language, 'apa')
+    assert words(language) == ('apa',)
+
+    add_word(language, 'bil')
+    assert words(language) == ('apa',)
+    increase_in_other_process('word')
+    assert sorted(words(language)) == ['apa', 'bil']
+
+    add_word(language, 'cykel')
+    models.Word.invalidate_pool()
+    assert sorted(words(language)) == ['apa', 'bil', 'cykel']
+
+
+def add_almost_correct(user, language, word, almost_correct):
+    mapping = models.AlmostCorrectWord('127.0.0.1', word, almost_correct)
+    mapping.user = user
+    mapping.language = language
+    db.session.add(mapping)
+    db.session.commit()
+
+
+def almost_correct(user, language):
+    with app.app_context():
+        return models.AlmostCorrectWord.lookup(user.id, language.id)
+
+
+def test_almost_correct_lookup(client):
+    owner = add_user('owner')
+    language = models.Language('swedish')
+    add_almost_correct(owner, language, 'bil', 'bill')
+    assert almost_correct(owner, language) == {'bil': {'bill'}}
+
+    add_almost_correct(owner, language, 'apa', 'apor')
+    assert almost_correct(owner, language) == {'bil': {'bill'}}
+    increase_in_other_process(f'almost_correct:{owner.id}')
+    assert almost_correct(owner, language) == {'bil': {'bill'},
+                                               'apa': {'apor'}}
+
+    add_almost_correct(owner, language, 'bil', 'bilar')
+    models.AlmostCorrectWord.invalidate(owner.id)
+    assert almost_correct(owner, language)['bil'] == {'bill', 'bilar'}
@@ -0,0 +1,278 @@
+"""Correction of recalls, in the request and by the background workers
+
+Run from the repository root: python -m pytest recall/test/test_corrections.py
+"""
+import collections
+import random
+import sqlite3
+import threading
+import types
+
+import pytest
+
+from recall import app, db
+from recall import corrections
+from recall import models
+from recall.test.test_views import client, add_user, login, add_memos
+
+
+class FlakyQueue(corrections.MemoryQueue):
+    """Fails to give the first job, as a locked SQLite database does"""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+        self.finished = threading.Event()
+
+    def get(self, timeout):
+        if not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError('database is locked')
+        return super().get(timeout)
+
+    def done(self, job):
+        self.finished.set()
+        # Parks the worker for the rest of the tests
+        threading.Event().wait()
+
+
+def test_worker_survives_queue_errors(monkeypatch):
+    queue = FlakyQueue()
+    monkeypatch.setattr(corrections, '_queue', queue)
+    monkeypatch.setattr(corrections, 'ERROR_DELAY', 0)
+    monkeypatch.setattr(corrections, '_run', lambda job: None)
+    queue.put(1, 1)
+    threading.Thread(target=corrections._work_forever, daemon=True).start()
+    assert queue.finished.wait(5)
+
+
+def test_old_sqlite_queues_in_memory(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(corrections, '_queue', None)
+    monkeypatch.setattr(sqlite3, 'sqlite_version_info', (3, 31, 1))
+    monkeypatch.setitem(app.config, 'CORRECTION_QUEUE',
+                        str(tmp_path / 'queue.db'))
+    monkeypatch.setitem(app.config, 'CORRECTION_WORKERS', 0)
+    corrections.start()
+    assert isinstance(corrections._queue, corrections.MemoryQueue)
+
+
+def test_job_put_again_while_taken(tmp_path):
+    queue = corrections.SQLiteQueue(str(tmp_path / 'queue.db'))
+    queue.put(1, 1)
+    job = queue.get(timeout=0)
+    # The owner asks for a re-correction while the job is corrected
+    queue.put(1, 1, full=True)
+    queue.done(job)
+    job = queue.get(timeout=0)
+    assert (job.recall_id, job.seq, job.full) == (1, 1, True)
+    queue.done(job)
+    assert len(queue) == 0
+
+
+def test_queue_created_before_generations(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE correction_job (recall_id INTEGER NOT NULL, '
+        'seq INTEGER NOT NULL, full_correction INTEGER NOT NULL, '
+        'attempts INTEGER NOT NULL, not_before REAL NOT NULL, '
+        'claimed_until REAL NOT NULL, PRIMARY KEY (recall_id, seq))')
+    connection.execute('INSERT INTO correction_job VALUES (1, 1, 0, 0, 0, 0)')
+    connection.commit()
+    connection.close()
+    queue = corrections.SQLiteQueue(path)
+    job = queue.get(timeout=0)
+    queue.done(job)
+    assert len(queue) == 0
+
+
+def test_recorrect_is_left_to_workers(client, monkeypatch):
+    queue = corrections.MemoryQueue()
+    monkeypatch.setattr(corrections, '_queue', queue)
+    owner = add_user('owner')
+    add_memos(owner, [owner], 1)
+    login(client, 'owner')
+
+    def correct(*args, **kwargs):
+        raise AssertionError('Corrected in the request')
+
+    monkeypatch.setattr(models.RecallData, 'correct', correct)
+    response = client.get('/arbeiter/correct/1', follow_redirects=True)
+    assert response.status_code == 200
+    assert "pollCorrection('/arbeiter/result/1')" in response.get_data(
+        as_text=True)
+    assert client.get('/arbeiter/result/1').get_json() == {'pending': True}
+    job = queue.get(timeout=0)
+    assert (job.recall_id, job.full) == (1, True)
+
+
+def test_recorrection_queued_again_at_start(client, monkeypatch):
+    monkeypatch.setattr(corrections, '_queue', corrections.MemoryQueue())
+    owner = add_user('owner')
+    add_memos(owner, [owner], 1)
+    login(client, 'owner')
+    client.get('/arbeiter/correct/1')
+    # The process restarts before the job in its memory is done
+    monkeypatch.setitem(app.config, 'CORRECTION_QUEUE', ':memory:')
+    monkeypatch.setitem(app.config, 'CORRECTION_WORKERS', 0)
+    corrections.start()
+    job = corrections._queue.get(timeout=0)
+    assert (job.recall_id, job.full) == (1, True)
+    assert len(corrections._queue) == 0
+
+
+WORDS = ['apa', 'bil', 'cykel', 'bil', 'dator']*9
+
+
+def add_memo(owner, discipline, data):
+    form = {'discipline': discipline, 'data': data, 'time': '5,15',
+            'language': 'swedish'}
+    memo = models.MemoData.from_form(form, '127.0.0.1', owner)
+    db.session.add(memo)
+    db.session.commit()
+    return memo
+
+
+def new_recall(memo, cells):
+    form = {f'r_{i}': cell for i, cell in enumerate(cells)}
+    form['seconds_remaining'] = '12.5'
+    request = types.SimpleNamespace(form=form, remote_addr='127.0.0.1')
+    recall = models.RecallData(request)
+    recall.memo = memo
+    recall.user = memo.user
+    return recall
+
+
+def numbers_recall(owner):
+    """Empty recall of 100 cells of 90 digits, in rows of 40, and
+    values to fill in"""
+    memo = add_memo(owner, 'base10', '3141592653'*9)
+    return new_recall(memo, ['']*100), [''] + [str(i) for i in range(10)]
+
+
+def words_recall(owner):
+    """Empty recall of 50 cells of 45 words, with 'bill' almost correct
+    for 'bil', and values to fill in"""
+    memo = add_memo(owner, 'words', '\n'.join(WORDS))
+    mapping = models.AlmostCorrectWord('127.0.0.1', 'bil', 'bill')
+    mapping.user = owner
+    mapping.language = memo.language
+    db.session.add(mapping)
+    db.session.commit()
+    models.AlmostCorrectWord.invalidate(owner.id)
+    return new_recall(memo, ['']*50), ['', 'bill', 'Apa', 'fel']
+
+
+def set_cells(recall, data):
+    """Change the cells of recall as RecallData.update does"""
+    recall.data = data
+    recall.seq += 1
+    recall.__dict__.pop('_start_of_emptiness', None)
+
+
+def assert_same_correction(correction, recall):
+    full = models.IncrementalCorrection(recall)
+    assert correction.cbc_r == full.cbc_r
+    assert correction.start_of_emptiness == full.start_of_emptiness
+    assert correction.raw_score(recall.memo) == full.raw_score(recall.memo)
+
+
+@pytest.mark.parametrize('get_recall', [numbers_recall, words_recall])
+def test_incremental_correction(client, get_recall):
+    owner = add_user('owner')
+    recall, values = get_recall(owner)
+    correction = models.IncrementalCorrection(recall)
+    prng = random.Random(0)
+    for _ in range(500):
+        changed = set()
+        data = list(recall.data)
+        for _ in range(prng.randint(1, 3)):
+            # Mostly fill in the cells in order, sometimes anywhere
+            if prng.random() < 0.8:
+                i = correction.start_of_emptiness + prng.randrange(-2, 3)
+            else:
+                i = prng.randrange(len(data))
+            i = min(max(i, 0), len(data) - 1)
+            if i < len(recall.memo) and prng.random() < 0.9:
+                data[i] = str(recall.memo.data[i])
+            else:
+                data[i] = prng.choice(values)
+            changed.add(i)
+        set_cells(recall, data)
+        correction.update(recall, sorted(changed))
+        assert_same_correction(correction, recall)
+
+
+def test_correct_reuses_previous_correction(client, monkeypatch):
+    monkeypatch.setattr(models, '_incremental_corrections',
+                        collections.OrderedDict())
+    owner = add_user('owner')
+    recall, _ = numbers_recall(owner)
+    db.session.commit()
+    recall.correct()
+    previous = models._incremental_corrections[recall.id]
+    set_cells(recall, ['3', '1', '4'] + ['']*97)
+    full = models.IncrementalCorrection(recall)
+
+    def correct_all(recall):
+        raise AssertionError('Corrected all cells again')
+
+    monkeypatch.setattr(models, 'IncrementalCorrection', correct_all)
+    raw_score, points, cbc_r = recall.correct(changed=[0, 1, 2])
+    assert models._incremental_corrections[recall.id] is previous
+    assert cbc_r == full.cbc_r
+    assert cbc_r[0:4] == [models.Item.correct]*3 + [models.Item.not_reached]
+
+
+
+def test_correction_after_new_almost_correct_word(client, monkeypatch):
+    monkeypatch.setattr(models, '_incremental_corrections',
+                        collections.OrderedDict())
+    owner = add_user('owner')
+    recall, _ = words_recall(owner)
+    db.session.commit()
+    set_cells(recall, ['apa', 'bilen'] + ['']*48)
+    assert recall.correct()[2][1] == models.Item.wrong
+
+    mapping = models.AlmostCorrectWord('127.0.0.1', 'bil', 'bilen')
+    mapping.user = owner
+    mapping.language = recall.memo.language
+    db.session.add(mapping)
+    db.session.commit()
+    models.AlmostCorrectWord.invalidate(owner.id)
+    set_cells(recall, ['apa', 'bilen'] + ['']*48)
+    assert recall.correct(changed=[])[2][1] == models.Item.almost_correct
+
+
+@pytest.mark.parametrize('discipline, nr_items, values', [
+    ('base2', 75, ['', '0', '1', '2']),
+    ('base10', 90, ['', '0', '7', '10', '-1', '9'*30, '0'*30 + '7']),
+    ('cards', 60, ['', '0', '51', '52', '200', '300']),
+])
+def test_vectorized_correction(client, monkeypatch, discipline, nr_items,
+                               values):
+    pytest.importorskip('numpy')
+    owner = add_user('owner')
+    form = {'discipline': discipline, 'nr_items': str(nr_items),
+            'time': '5,15'}
+    memo = models.MemoData.from_form(form, '127.0.0.1', owner)
+    db.session.add(memo)
+    db.session.commit()
+    prng = random.Random(0)
+    for _ in range(50):
+        # Mostly correct cells, with gaps and cells after the data
+        cells = [str(item) if prng.random() < 0.9 else prng.choice(values)
+                 for item in memo.data]
+        cells += [prng.choice(values) for _ in range(10)]
+        start = prng.randrange(len(cells))
+        for i in range(start, min(start + prng.randrange(30), len(cells))):
+            cells[i] = ''
+        recall = new_recall(memo, cells)
+        vectorized = models.IncrementalCorrection(recall)
+        with monkeypatch.context() as m:
+            m.setattr(models, 'numpy', None)
+            pure = models.IncrementalCorrection(recall)
+        for name in ('cbc_r', 'start_of_emptiness', 'row_correct',
+                     'row_hits', 'row_halves', 'halves'):
+            assert getattr(vectorized, name) == getattr(pure, name), name
+        assert vectorized.raw_score(memo) == pure.raw_score(memo)
@@ -0,0 +1,116 @@
+"""Binary encodings of recalls, corrections and memorizations
+
+Run from the repository root: python -m pytest recall/test/test_encoding.py
+"""
+import pickle
+
+import pytest
+
+from recall import encoding
+from recall import models
+
+
+@pytest.mark.parametrize('cells, cell_format', [
+    ([], encoding.BINARY),
+    (['1', '', '0', '1', '1'], encoding.BINARY),
+    (['9', '', '0', '5'], encoding.NIBBLES),
+    (['9', '', '0', '5', '3'], encoding.NIBBLES),
+    (['51', '', '0', '254'], encoding.BYTES),
+    (['255', '1'], encoding.TEXT),
+    (['bil', '', 'Åsa', '1492-10-12'], encoding.TEXT),
+])
+def test_cells(cells, cell_format):
+    data = encoding.pack_cells(cells)
+    assert data[0] == cell_format
+    assert encoding.unpack_cells(data) == cells
+
+
+def test_pickled_cells():
+    cells = ['3', '', '1', 'bil']
+    assert encoding.unpack_cells(pickle.dumps(cells)) == cells
+
+
+@pytest.mark.parametrize('nr_cells', [0, 1, 8, 9, 61])
+def test_items(nr_cells):
+    codes = [i % 6 for i in range(nr_cells)]
+    data = encoding.pack_items(codes)
+    assert len(data) == encoding.HEADER.size + 3*((nr_cells + 7)//8)
+    assert encoding.unpack_items(data) == codes
+
+
+def test_pickled_items():
+    items = [models.Item.correct, models.Item.wrong, models.Item.gap]
+    assert encoding.unpack_items(pickle.dumps(items)) == [
+        item.value for item in items]
+
+
+def test_correction_cells():
+    cell_by_cell = [models.Item.correct]*3 + [models.Item.almost_correct,
+                                              models.Item.not_reached]
+    correction = models.Correction(3, 3, cell_by_cell)
+    assert (correction.correct, correction.consecutive) == (3, 3)
+    assert correction.cell_by_cell == cell_by_cell
+
+
+@pytest.mark.parametrize('data, memo_format', [
+    ((1, 0, 1, 1, 0, 0, 1, 0, 1), encoding.MEMO_BITS),
+    ((3, 1, 4, 1, 5), encoding.MEMO_NIBBLES),
+    ((3, 1, 4, 1, 5, 9), encoding.MEMO_NIBBLES),
+    ((51, 0, 26), encoding.MEMO_BYTES),
+    (('bil', 'åsna', 'cykel'), encoding.MEMO_TEXT),
+    (((1492, 'Columbus seglar', 1), (2019, 'Öl', 0)), encoding.MEMO_DATES),
+    ((3, 'bil'), None),
+])
+def test_memo(data, memo_format):
+    assert encoding.unpack_memo(encoding.pack_memo(data, memo_format)) == data
+
+
+def test_pickled_memo():
+    data = [3, 1, 4, 1]
+    assert encoding.unpack_memo(pickle.dumps(data)) == tuple(data)
+
+
+def test_unknown_memo_format():
+    with pytest.raises(ValueError):
+        encoding.pack_memo((1, 2), 99)
+
+
+def test_splitmix64():
+    # Reference output of SplitMix64, seeds stored in the database
+    # must give the same items in every version
+    numbers = models._splitmix64(1234567)
+    assert [next(numbers) for _ in range(3)] == [
+        6457827717110365317, 3203168211198807973, 9817491932198370423]
+
+
+def seeded_memo(cls, nr_items, seed):
+    discipline = cls.__mapper_args__['polymorphic_identity']
+    memo = cls('127.0.0.1', discipline, 5, 15, None, True)
+    memo.seed_data(nr_items, seed)
+    return memo
+
+
+@pytest.mark.parametrize('cls, items', [
+    (models.Base2Data, (1, 1, 0, 1, 1, 0, 1, 1, 0, 0, 1, 0)),
+    (models.Base10Data, (5, 9, 0, 5, 1, 8, 5, 3, 0, 0, 7, 0)),
+    (models.CardData, (19, 8, 16, 33, 20, 43, 23, 18, 47, 10, 17, 25)),
+])
+def test_seeded_data(cls, items):
+    data = seeded_memo(cls, 104, seed=1).data
+    assert len(data) == 104 and data[0:12] == items
+    models._seeded_data.cache_clear()
+    assert seeded_memo(cls, 104, seed=1).data == data
+    assert seeded_memo(cls, 104, seed=2).data != data
+
+
+def test_seeded_cards():
+    data = seeded_memo(models.CardData, 104, seed=1).data
+    deck = list(range(models.NR_CARDS_IN_DECK))
+    assert sorted(data[0:52]) == deck and sorted(data[52:104]) == deck
+
+
+def test_unknown_prng():
+    memo = seeded_memo(models.Base10Data, 10, seed=1)
+    memo.prng = 99
+    with pytest.raises(ValueError):
+        memo.data
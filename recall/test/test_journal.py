@@ -0,0 +1,93 @@
+"""Autosaves of recalls deleted while in the write-behind journal
+
+Run from the repository root: python -m pytest recall/test/test_journal.py
+"""
+import pytest
+
+from recall import app, db
+from recall import journal
+from recall import models
+from recall.test.test_views import client, add_user, login, add_memos
+from recall.test.test_views import post_recall
+
+
+@pytest.fixture
+def owner(client, tmp_path, monkeypatch):
+    """Logged in owner of memo 1, with an autosave in the journal"""
+    monkeypatch.setitem(app.config, 'AUTOSAVE_JOURNAL',
+                        str(tmp_path / 'journal.db'))
+    journal._local.connection = None
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    post_recall(client, 1, owner.id, ['1']*60)
+    post_recall(client, 1, owner.id, ['0']*60)
+    assert journal.get(1, owner.id).seq == 2
+    yield owner
+    journal._local.connection = None
+
+
+def delete_recalls():
+    """Delete behind the back of the journal"""
+    db.session.execute(models.RecallData.__table__.delete())
+    db.session.commit()
+
+
+def test_delete_recall(client, owner):
+    client.get('/delete/recall/1')
+    assert journal.get(1, owner.id) is None
+    assert journal.flush() == 0
+
+
+def test_delete_memo(client, owner):
+    client.get('/delete/memo/1')
+    assert journal.get(1, owner.id) is None
+
+
+def test_final_submit_of_missing_recall(client, owner):
+    delete_recalls()
+    response = post_recall(client, 1, owner.id, ['0']*60, locked=True)
+    assert 'points' in response.get_json()
+    recall, = models.RecallData.query.all()
+    assert recall.locked and recall.data == ['0']*60
+    assert journal.get(1, owner.id) is None
+
+
+def test_flush_of_missing_recall(client, owner):
+    delete_recalls()
+    assert journal.flush() == 1
+    recall, = models.RecallData.query.all()
+    assert recall.data == ['0']*60 and recall.seq == 2
+
+
+def test_flush_of_missing_memo(client, owner):
+    delete_recalls()
+    db.session.execute(models.MemoData.__table__.delete())
+    db.session.commit()
+    assert journal.flush() == 1
+    assert models.RecallData.query.count() == 0
+    assert journal.get(1, owner.id) is None
+
+
+def test_delete_account_of_competitor(client, owner):
+    alice = add_user('alice')
+    login(client, 'alice')
+    post_recall(client, 1, alice.id, ['1']*60)
+    post_recall(client, 1, alice.id, ['0']*60)
+    assert journal.get(1, alice.id).seq == 2
+    add_user('penlect')
+    login(client, 'penlect')
+    client.get('/delete/account/alice')
+    assert journal.get(1, alice.id) is None
+    assert journal.flush() == 1
+    assert [recall.user_id for recall in models.RecallData.query] == [
+        owner.id]
+
+
+def test_flush_of_missing_user(client, owner):
+    delete_recalls()
+    db.session.execute(models.User.__table__.delete())
+    db.session.commit()
+    assert journal.flush() == 1
+    assert models.RecallData.query.count() == 0
+    assert journal.get(1, owner.id) is None
@@ -0,0 +1,196 @@
+"""Migration of a database created by the first version of the app
+
+The migration and the application run in their own processes, on a
+copy of the baseline schema with rows stored as that version did.
+
+Run from the repository root: python -m pytest recall/test/test_migrate.py
+"""
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from recall import models
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+BASELINE_SCHEMA = '''
+CREATE TABLE language (
+    id INTEGER NOT NULL,
+    language VARCHAR(80) NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (language)
+);
+CREATE TABLE user (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    username VARCHAR(80) NOT NULL,
+    password VARCHAR(128) NOT NULL,
+    email VARCHAR(120),
+    real_name VARCHAR(120),
+    country VARCHAR(120),
+    settings BLOB,
+    blocked BOOLEAN,
+    PRIMARY KEY (id),
+    UNIQUE (username)
+);
+CREATE TABLE almost_correct_word (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    ip VARCHAR(40) NOT NULL,
+    word VARCHAR(80) NOT NULL,
+    almost_correct VARCHAR(80) NOT NULL,
+    language_id INTEGER,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE TABLE memo_data (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    ip VARCHAR(40) NOT NULL,
+    discipline VARCHAR(6) NOT NULL,
+    memo_time INTEGER NOT NULL,
+    recall_time INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    generated BOOLEAN NOT NULL,
+    state VARCHAR(11) NOT NULL,
+    user_id INTEGER,
+    language_id INTEGER,
+    PRIMARY KEY (id)
+);
+CREATE TABLE story (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    ip VARCHAR(40) NOT NULL,
+    username VARCHAR(40) NOT NULL,
+    story VARCHAR(100) NOT NULL,
+    language_id INTEGER,
+    PRIMARY KEY (id)
+);
+CREATE TABLE word (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    ip VARCHAR(40) NOT NULL,
+    username VARCHAR(40) NOT NULL,
+    word VARCHAR(80) NOT NULL,
+    word_class VARCHAR(15) NOT NULL,
+    language_id INTEGER,
+    PRIMARY KEY (id)
+);
+CREATE TABLE recall_data (
+    id INTEGER NOT NULL,
+    datetime DATETIME NOT NULL,
+    ip VARCHAR(40) NOT NULL,
+    data BLOB NOT NULL,
+    time_remaining FLOAT NOT NULL,
+    locked BOOLEAN NOT NULL,
+    user_id INTEGER NOT NULL,
+    memo_id INTEGER NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE TABLE correction (
+    id INTEGER NOT NULL,
+    off_limits INTEGER NOT NULL,
+    gap INTEGER NOT NULL,
+    not_reached INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    wrong INTEGER NOT NULL,
+    almost_correct INTEGER NOT NULL,
+    consecutive INTEGER NOT NULL,
+    raw_score FLOAT NOT NULL,
+    points FLOAT NOT NULL,
+    cell_by_cell BLOB,
+    recall_id INTEGER,
+    PRIMARY KEY (id)
+);
+'''
+
+DATETIME = '2019-05-01 12:00:00.000000'
+
+
+def add_legacy_rows(connection):
+    """Memo of owner, with a corrected recall of alice and two
+    uncorrected recalls of owner, pickled as the baseline did"""
+    for user_id, username in ((1, 'owner'), (2, 'alice')):
+        connection.execute(
+            'INSERT INTO user (id, datetime, username, password) '
+            'VALUES (?, ?, ?, ?)', (user_id, DATETIME, username, 'x'))
+    connection.execute(
+        'INSERT INTO memo_data VALUES (1, ?, ?, ?, 5, 15, ?, 1, ?, 1, NULL)',
+        (DATETIME, '127.0.0.1', 'base10', pickle.dumps([3, 1, 4, 1]),
+         'public'))
+    # Recall 3 was stored by a submit concurrent with the one of 2
+    for recall_id, user_id in ((1, 2), (2, 1), (3, 1)):
+        connection.execute(
+            'INSERT INTO recall_data VALUES (?, ?, ?, ?, 0.0, 1, ?, 1)',
+            (recall_id, DATETIME, '127.0.0.1',
+             pickle.dumps(['3', '1', '4', '2']), user_id))
+    cell_by_cell = [models.Item.correct]*3 + [models.Item.wrong]
+    connection.execute(
+        'INSERT INTO correction VALUES (1, 0, 0, 0, 3, 1, 0, 3, 3, 3, ?, 1)',
+        (pickle.dumps(cell_by_cell),))
+
+
+def run(database, *args, **environ):
+    env = dict(os.environ, FLASK_DEBUG='1',
+               RECALL_DATABASE_URI=f'sqlite:///{database}',
+               RECALL_AUTOSAVE_JOURNAL='', RECALL_CORRECTION_QUEUE='')
+    env.update(environ)
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(BASELINE_SCHEMA)
+    add_legacy_rows(connection)
+    connection.commit()
+    connection.close()
+    run(path, '-m', 'recall.migrate')
+    return path
+
+
+def test_migrated_recalls(database):
+    connection = sqlite3.connect(database)
+    rows = connection.execute('SELECT id, seq, digest FROM recall_data')
+    assert rows.fetchall() == [(1, 0, None), (3, 0, None)]
+
+
+def test_app_starts_on_migrated_database(database):
+    script = ('import recall\n'
+              'client = recall.app.test_client()\n'
+              'print(client.get("/login").status_code)\n')
+    assert run(database, '-c', script).split() == ['200']
+
+
+def test_migrated_corrections(database):
+    connection = sqlite3.connect(database)
+    rows = connection.execute('SELECT recall_id, seq FROM correction')
+    assert rows.fetchall() == [(1, 0)]
+
+
+def test_only_uncorrected_recalls_queued(database):
+    script = ('import recall\n'
+              'recall.app.test_client().get("/login")\n'
+              'print(recall.metrics.counters["correction.queued"])\n')
+    # Recall 3 was never corrected, recall 1 is not corrected again
+    output = run(database, '-c', script, RECALL_CORRECTION_QUEUE=':memory:')
+    assert output.split() == ['1']
+
+
+def test_recalls_unique(database):
+    connection = sqlite3.connect(database)
+    with pytest.raises(sqlite3.IntegrityError):
+        connection.execute(
+            'INSERT INTO recall_data (datetime, ip, data, time_remaining, '
+            'locked, user_id, memo_id) VALUES (?, ?, ?, 0.0, 0, 1, 1)',
+            (DATETIME, '127.0.0.1', b''))
@@ -0,0 +1,112 @@
+"""Scheduling of autosaves, and what is stored of the scheduled ones
+
+Run from the repository root: python -m pytest recall/test/test_schedule.py
+"""
+import atexit
+import collections
+import math
+
+import pytest
+
+from recall import app, db
+from recall import journal
+from recall import metrics
+from recall import models
+from recall import schedule
+from recall.test.test_views import client, add_user, login, add_memos
+from recall.test.test_views import post_recall
+
+NOW = 1000.0
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """Two autosaves per slot of 0.5 s, each given the middle of it"""
+    monkeypatch.setattr(schedule.random, 'random', lambda: 0.5)
+    return schedule.AutosaveScheduler(interval=10, max_interval=60,
+                                      capacity=4)
+
+
+def slot_loads(scheduler, delays):
+    return collections.Counter(math.floor((NOW + delay)/scheduler.slot_length)
+                               for delay in delays)
+
+
+def test_burst_spread_around_interval(scheduler):
+    delays = [scheduler.next_delay(NOW) for _ in range(40)]
+    assert max(slot_loads(scheduler, delays).values()) == 2
+    assert 5 <= min(delays) and max(delays) <= 15.5
+
+
+def test_overload_backs_off(scheduler):
+    backoffs = metrics.counters['autosave.backoff']
+    delays = [scheduler.next_delay(NOW) for _ in range(60)]
+    assert max(slot_loads(scheduler, delays).values()) == 2
+    assert 15.5 < max(delays) <= 60
+    assert metrics.counters['autosave.backoff'] == backoffs + 18
+
+
+def test_passed_slots_forgotten(scheduler):
+    for _ in range(40):
+        scheduler.next_delay(NOW)
+    assert 5 <= scheduler.next_delay(NOW + 100) <= 15.5
+    assert len(scheduler.slots) == 1
+
+
+@pytest.fixture
+def owner(client, tmp_path, monkeypatch):
+    """Logged in owner of memo 1, autosaving to the journal"""
+    monkeypatch.setitem(app.config, 'AUTOSAVE_JOURNAL',
+                        str(tmp_path / 'journal.db'))
+    journal._local.connection = None
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    yield owner
+    journal._local.connection = None
+
+
+def stored_recall():
+    recall, = models.RecallData.query.all()
+    db.session.expire(recall)
+    return recall
+
+
+def test_rapid_autosaves_coalesced(client, owner):
+    for i in range(5):
+        response = post_recall(client, 1, owner.id, [str(i)]*60).get_json()
+        assert response['seq'] == i + 1
+        assert 0 < response['next_autosave'] <= app.config[
+            'AUTOSAVE_MAX_INTERVAL']
+    # Only the first autosave created the recall, the others replace
+    # each other in the journal
+    assert stored_recall().seq == 1
+    assert journal.get(1, owner.id).seq == 5
+    assert journal.flush() == 1
+    recall = stored_recall()
+    assert (recall.seq, recall.data) == (5, ['4']*60)
+
+
+def test_unchanged_autosave_deduplicated(client, owner):
+    deduplicated = metrics.counters['autosave.deduplicated']
+    post_recall(client, 1, owner.id, ['1']*60)
+    post_recall(client, 1, owner.id, ['0']*60)
+    response = post_recall(client, 1, owner.id, ['0']*60).get_json()
+    assert response['seq'] == 2 and 'next_autosave' in response
+    assert metrics.counters['autosave.deduplicated'] == deduplicated + 1
+    assert journal.get(1, owner.id).seq == 2
+
+
+def test_flush_at_exit(client, owner, monkeypatch):
+    at_exit = list()
+    monkeypatch.setattr(atexit, 'register', at_exit.append)
+    monkeypatch.setattr(journal, '_flush_forever', lambda: None)
+    journal.start()
+    post_recall(client, 1, owner.id, ['1']*60)
+    post_recall(client, 1, owner.id, ['0']*60)
+    assert stored_recall().seq == 1
+    for function in at_exit:
+        function()
+    recall = stored_recall()
+    assert (recall.seq, recall.data) == (2, ['0']*60)
+    assert journal.get(1, owner.id) is None
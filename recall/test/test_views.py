@@ -0,0 +1,305 @@
+"""Number of queries of the views
+
+Run from the repository root: python -m pytest recall/test/test_views.py
+"""
+import datetime
+import types
+
+import pytest
+import sqlalchemy
+
+from recall import app, db
+from recall import models
+from recall import views
+from recall import corrections
+
+# The user page needs the logged in user, the user shown, the memos
+# and the recalls, however many there are
+USER_PAGE_MAX_QUERIES = 5
+# An autosave reads the logged in user and the recall, and stores the
+# recall
+AUTOSAVE_MAX_QUERIES = 3
+
+
+@pytest.fixture
+def client():
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False,
+                      XLS_PRERENDER=False,
+                      SQLALCHEMY_DATABASE_URI='sqlite://')
+    db.create_all()
+    yield app.test_client()
+    db.session.remove()
+    db.drop_all()
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+
+
+def add_user(username):
+    user = models.User(username, 'password123', f'{username}@example.com',
+                       username.title(), 'Sweden')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username):
+    response = client.post('/login', data={'username': username,
+                                           'password': 'password123'})
+    assert response.status_code == 302
+
+
+def add_memos(user, competitors, n):
+    """Add n memos of user, each with a corrected recall per competitor"""
+    language = (models.Language.query.filter_by(language='swedish').first()
+                or models.Language('swedish'))
+    disciplines = ('base2', 'base10', 'cards')
+    states = list(models.State)
+    for i in range(n):
+        form = {'discipline': disciplines[i % 3], 'nr_items': '60',
+                'time': '5,15'}
+        memo = models.MemoData.from_form(form, '127.0.0.1', user)
+        memo.state = states[i % 3]
+        if i % 2:
+            memo.language = language
+        db.session.add(memo)
+        for competitor in competitors:
+            form = {f'r_{j}': str(j % 2) for j in range(60)}
+            form['seconds_remaining'] = '12.5'
+            request = types.SimpleNamespace(form=form,
+                                            remote_addr='127.0.0.1')
+            recall = models.RecallData(request)
+            recall.memo = memo
+            recall.user = competitor
+            recall.locked = True
+            db.session.add(recall)
+            corrections.correct(recall)
+    db.session.commit()
+
+
+def user_page_queries(client, username, delete_column=False):
+    url = f'/competition/{username}' + ('/delete' if delete_column else '')
+    response = client.get(url)
+    assert response.status_code == 200
+    return int(response.headers['X-Query-Count'])
+
+
+@pytest.mark.parametrize('delete_column', [False, True])
+def test_user_page_queries(client, delete_column):
+    owner = add_user('owner')
+    competitors = [owner, add_user('alice'), add_user('bob')]
+    login(client, 'owner')
+
+    add_memos(owner, competitors, 6)
+    few = user_page_queries(client, 'owner', delete_column)
+    add_memos(owner, competitors, 30)
+    many = user_page_queries(client, 'owner', delete_column)
+
+    assert many <= USER_PAGE_MAX_QUERIES
+    assert many == few
+
+
+def test_other_user_page_queries(client):
+    owner = add_user('owner')
+    competitors = [owner, add_user('alice')]
+    add_memos(owner, competitors, 12)
+    login(client, 'alice')
+    assert user_page_queries(client, 'owner') <= USER_PAGE_MAX_QUERIES
+
+
+def json_pages(client, url):
+    """All rows of the json pages of a table, following the cursors"""
+    rows = list()
+    while url is not None:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_json()
+        rows.extend(page['rows'])
+        url = page['next']
+    return rows
+
+
+@pytest.mark.parametrize('table', ['memos', 'recalls'])
+def test_user_table_pages(client, monkeypatch, table):
+    monkeypatch.setattr('recall.views.PAGE_SIZE', 4)
+    owner = add_user('owner')
+    add_memos(owner, [owner, add_user('alice')], 9)
+    login(client, 'owner')
+
+    rows = json_pages(client, f'/competition/owner/{table}?format=json')
+    model = models.MemoData if table == 'memos' else models.RecallData
+    expected = model.query.order_by(model.datetime.desc(), model.id.desc())
+    assert [row['id'] for row in rows] == [row.id for row in expected]
+
+
+def test_user_table_filters(client, monkeypatch):
+    monkeypatch.setattr('recall.views.PAGE_SIZE', 2)
+    owner = add_user('owner')
+    add_memos(owner, [owner], 12)
+    login(client, 'owner')
+
+    rows = json_pages(client, '/competition/owner/memos?format=json'
+                              '&discipline=base10&language=swedish')
+    assert [row['id'] for row in rows] == [8, 2]
+    rows = json_pages(client, '/competition/owner/recalls?format=json'
+                              '&state=public')
+    assert {row['memo']['state'] for row in rows} == {'public'}
+    assert len(rows) == 4
+    response = client.get('/competition/owner/memos?discipline=base16')
+    assert response.status_code == 400
+
+
+def test_user_table_html_pages(client, monkeypatch):
+    monkeypatch.setattr('recall.views.PAGE_SIZE', 5)
+    owner = add_user('owner')
+    add_memos(owner, [owner], 7)
+    login(client, 'owner')
+
+    page = client.get('/competition/owner').get_data(as_text=True)
+    assert page.count('class="next-page"') == 4
+    response = client.get('/competition/owner/memos?after=2000-01-01_1')
+    assert response.status_code == 200
+    assert '<tr>' not in response.get_data(as_text=True)
+    response = client.get('/competition/owner/memos?after=yesterday')
+    assert response.status_code == 400
+
+
+def test_competitions_pages(client, monkeypatch):
+    monkeypatch.setattr('recall.views.PAGE_SIZE', 3)
+    usernames = [add_user(f'user{i}').username for i in range(8)]
+    login(client, 'user0')
+
+    rows = json_pages(client, '/competitions/rows?format=json')
+    assert [row['username'] for row in rows] == usernames
+    page = client.get('/competitions').get_data(as_text=True)
+    assert 'user2' in page and 'user3' not in page
+
+
+def post_recall(client, memo_id, user_id, cells, locked=False):
+    form = {f'r_{i}': cell for i, cell in enumerate(cells)}
+    form.update(memo_id=memo_id, user_id=user_id, seconds_remaining='30',
+                locked='true' if locked else 'false')
+    response = client.post('/arbeiter', data=form)
+    assert response.status_code == 200
+    return response
+
+
+def test_autosave_of_recall_without_digest(client):
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    cells = ['1']*60
+    assert post_recall(client, 1, owner.id, cells).get_json()['seq'] == 1
+    assert post_recall(client, 1, owner.id, cells).get_json()['seq'] == 1
+
+    # Stored before digests were, the same cells are taken as changed
+    table = models.RecallData.__table__
+    db.session.execute(table.update().values(digest=None))
+    db.session.commit()
+    assert post_recall(client, 1, owner.id, cells).get_json()['seq'] == 2
+    digest = db.session.execute(sqlalchemy.select([table.c.digest])).scalar()
+    assert digest == models.RecallData.digest_cells(cells)
+    assert post_recall(client, 1, owner.id, cells).get_json()['seq'] == 2
+
+
+def test_autosave_queries(client):
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    for cells in (['1']*60, ['1']*60, ['0']*60):
+        response = post_recall(client, 1, owner.id, cells)
+        assert int(response.headers['X-Query-Count']) <= AUTOSAVE_MAX_QUERIES
+
+
+def test_concurrent_first_submits(client, monkeypatch):
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    store_recall = views._store_recall
+
+    def store_other_submit_first(*args):
+        # The other submit is stored between our select and insert
+        monkeypatch.setattr(views, '_store_recall', store_recall)
+        db.session.execute(models.RecallData.__table__.insert().values(
+            datetime=datetime.datetime.utcnow(), ip='127.0.0.1',
+            data=['0']*60, time_remaining=40.0, locked=False, seq=1,
+            user_id=owner.id, memo_id=1))
+        db.session.commit()
+        return store_recall(*args)
+
+    monkeypatch.setattr(views, '_store_recall', store_other_submit_first)
+    response = post_recall(client, 1, owner.id, ['1']*60)
+    assert response.get_json()['seq'] == 2
+    recall, = models.RecallData.query.all()
+    assert recall.data == ['1']*60
+
+
+def post_delta(client, memo_id, user_id, seq, cells):
+    form = {f'r_{i}': cell for i, cell in cells.items()}
+    form.update(memo_id=memo_id, user_id=user_id, seconds_remaining='30',
+                locked='false', delta='true', seq=seq)
+    response = client.post('/arbeiter', data=form)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_patch_cells_out_of_sync():
+    with pytest.raises(models.RecallOutOfSync):
+        models.RecallData.patch_cells(['1']*4, 2, {'seq': '1', 'r_0': '0'})
+    with pytest.raises(models.RecallOutOfSync):
+        models.RecallData.patch_cells(['1']*4, 2, {'seq': '2', 'r_4': '0'})
+    data, changed = models.RecallData.patch_cells(
+        ['1']*4, 2, {'seq': '2', 'r_1': ' 0 ', 'memo_id': '1'})
+    assert (data, changed) == (['1', '0', '1', '1'], [1])
+
+
+def test_autosave_of_delta(client):
+    owner = add_user('owner')
+    add_memos(owner, [], 1)
+    login(client, 'owner')
+    assert post_delta(client, 1, owner.id, 0, {0: '0'}) == {'resync': True,
+                                                          'seq': None}
+    post_recall(client, 1, owner.id, ['1']*60)
+    # A delta of a submit that was never acknowledged
+    assert post_delta(client, 1, owner.id, 0, {0: '0'}) == {'resync': True,
+                                                          'seq': 1}
+    assert post_delta(client, 1, owner.id, 1, {0: '0'})['seq'] == 2
+    recall, = models.RecallData.query.all()
+    assert recall.data == ['0'] + ['1']*59
+
+
+@pytest.mark.parametrize('discipline', ['base10', 'cards', 'words'])
+@pytest.mark.parametrize('nr_items', ['0', '-5', '20001', 'many'])
+def test_make_invalid_nr_items(client, discipline, nr_items):
+    add_user('owner')
+    login(client, 'owner')
+    form = {'discipline': discipline, 'nr_items': nr_items, 'time': '5,15',
+            'language': 'swedish'}
+    message = ('Number of items must be 1 to 20000' if nr_items != 'many'
+               else 'invalid literal for int()')
+    response = client.post('/make', data=form)
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).startswith(
+        'Failed to create discipline: ' + message)
+    response = client.post('/make/batch', json={'memos': [form]})
+    assert response.status_code == 200
+    assert response.get_json()['error'].startswith(
+        'Failed to create memorization 0: ' + message)
+    assert models.MemoData.query.count() == 0
+
+
+def test_make_batch_invalid_pattern(client):
+    add_user('owner')
+    login(client, 'owner')
+    specs = [{'discipline': 'base10', 'nr_items': 80, 'time': '5,15',
+              'pattern': '4, 4'},
+             {'discipline': 'base10', 'nr_items': 80, 'time': '5,15',
+              'pattern': '4, x'}]
+    response = client.post('/make/batch', json={'memos': specs})
+    assert response.status_code == 200
+    assert response.get_json()['error'].startswith(
+        'Failed to create memorization 1: The pattern "4, x"')
+    assert models.MemoData.query.count() == 0
+
+    response = client.post('/make/batch', json={'memos': specs[0:1]})
+    memo, = response.get_json()['memos']
+    assert 'pattern=4%2C4' in memo['xls']
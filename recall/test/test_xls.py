@@ -0,0 +1,54 @@
+"""Rendering of memorization sheets, and the cache of rendered sheets
+
+Run from the repository root: python -m pytest recall/test/test_xls.py
+"""
+import os
+
+import pytest
+
+import recall.xls
+from recall import app
+from recall import sheets
+
+HEADER = recall.xls.Header('Title', 'Description', 'Key', 5, 15)
+
+
+@pytest.mark.parametrize('file_format', recall.xls.FORMATS)
+def test_render_file(tmp_path, file_format):
+    path = str(tmp_path / f'sheet.{file_format}')
+    recall.xls.render_file(path, recall.xls.get_decimal_table, HEADER,
+                           [3, 1, 4, 1, 5]*20, '', file_format)
+    assert os.listdir(tmp_path) == [f'sheet.{file_format}']
+
+
+def get_table_failing_to_save(**kwargs):
+    table = recall.xls.get_decimal_table(**kwargs)
+    save = table.save
+
+    def save_and_fail(path):
+        save(path)
+        raise OSError('No space left on device')
+
+    table.save = save_and_fail
+    return table
+
+
+@pytest.mark.parametrize('file_format', recall.xls.FORMATS)
+def test_failed_render_leaves_no_file(tmp_path, file_format):
+    path = str(tmp_path / f'sheet.{file_format}')
+    with pytest.raises(OSError):
+        recall.xls.render_file(path, get_table_failing_to_save, HEADER,
+                               [3, 1, 4, 1, 5]*20, '', file_format)
+    assert os.listdir(tmp_path) == []
+
+
+def test_purge_leaves_renders_in_progress(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'root_path', str(tmp_path))
+    (tmp_path / 'xls').mkdir()
+    names = ['1_abc.xls', '1_abc.xlsx', '1_abc.xls.123.tmp',
+             '11_abc.xls', '2_abc.xls']
+    for name in names:
+        (tmp_path / 'xls' / name).write_bytes(b'sheet')
+    sheets.purge([1])
+    assert sorted(os.listdir(tmp_path / 'xls')) == [
+        '11_abc.xls', '1_abc.xls.123.tmp', '2_abc.xls']
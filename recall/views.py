@@ -1,12 +1,15 @@
 
 import os
 from flask import (render_template, request, jsonify, url_for,
-                   flash, redirect, send_from_directory)
+                   flash, redirect, send_from_directory, Response,
+                   stream_with_context)
 from flask_login import login_user, logout_user, current_user, login_required
 import math
 import collections
 import json
 import functools
+import datetime
+import urllib.parse
 
 import sqlalchemy.orm
 from passlib.hash import sha256_crypt
@@ -14,6 +17,11 @@ import requests
 
 from recall import app, db, login_manager
 from recall import models
+from recall import metrics
+from recall import journal
+from recall import corrections
+from recall import schedule
+from recall import sheets
 import recall.xls
 
 import logging
@@ -151,8 +159,15 @@ def delete_account(username):
         user = models.User.query.filter_by(username=username).one()
     except sqlalchemy.orm.exc.NoResultFound:
         return f'No such user "{username}"'
+    user_id = user.id
+    memo_ids = [memo.id for memo in user.memos]
+    if journal.enabled():
+        journal.discard_memos(memo_ids)
+        journal.discard_user(user_id)
     db.session.delete(user)
     db.session.commit()
+    models.AlmostCorrectWord.invalidate(user_id)
+    sheets.purge(memo_ids)
     flash(f'Account "{username}" deleted.', 'danger')
     app.logger.info(f'User deleted account: {username}')
     return redirect(url_for('index'))
@@ -168,18 +183,25 @@ def delete_memo(memo_id):
         flash('You can only delete your own memos', 'danger')
     else:
         flash(f'Deleted memo {memo_id}', 'danger')
+        if journal.enabled():
+            journal.discard_memos([memo_id])
         db.session.delete(memo)
         db.session.commit()
+        sheets.purge([memo_id])
     return redirect(url_for('user_delete_column', username=current_user.username))
 
 
 @app.route('/delete/all_memos')
 @login_required
 def delete_all_memos():
+    memo_ids = [memo.id for memo in current_user.memos]
+    if journal.enabled():
+        journal.discard_memos(memo_ids)
     for memo in current_user.memos:
         db.session.delete(memo)
     flash(f'Deleted all memos', 'danger')
     db.session.commit()
+    sheets.purge(memo_ids)
     return redirect(url_for('user', username=current_user.username))
 
 
@@ -194,6 +216,8 @@ def delete_recall(recall_id):
               'danger')
     else:
         flash(f'Deleted recall {recall_id}', 'danger')
+        if journal.enabled():
+            journal.discard(recall.memo_id, recall.user_id)
         db.session.delete(recall)
         db.session.commit()
     return redirect(url_for('user_delete_column', username=current_user.username))
@@ -206,6 +230,8 @@ def delete_all_recalls():
     for memo in current_user.memos:
         for recall in memo.recalls:
             if recall.user_id == current_user.id:
+                if journal.enabled():
+                    journal.discard(recall.memo_id, recall.user_id)
                 db.session.delete(recall)
     flash(f'Deleted recalls', 'danger')
     db.session.commit()
@@ -223,6 +249,7 @@ def delete_story():
         flash(f'Deleted story "{story.story}".', 'danger')
         db.session.delete(story)
         db.session.commit()
+        models.Story.invalidate_pool()
     return 'Done'
 
 
@@ -237,6 +264,7 @@ def delete_word():
         flash(f'Deleted word "{word.word}".', 'danger')
         db.session.delete(word)
         db.session.commit()
+        models.Word.invalidate_pool()
     return 'Done'
 
 
@@ -251,8 +279,10 @@ def delete_almost_correct_word():
         flash('Not allowed to delete', 'danger')
     else:
         flash(f'Deleted almost-correct-word "{mapping.almost_correct}".', 'danger')
+        user_id = mapping.user_id
         db.session.delete(mapping)
         db.session.commit()
+        models.AlmostCorrectWord.invalidate(user_id)
     return 'Done'
 
 
@@ -272,11 +302,164 @@ def change_state(memo_id, state):
         return f'Unknown state {state}'
 
 
+# Rows per page of the competitions, memo and recall tables
+PAGE_SIZE = 50
+# Columns of MemoData shown in the memo and recall tables
+MEMO_COLUMNS = ('id', 'datetime', 'discipline', 'memo_time', 'recall_time',
+                'nr_items', 'state', 'user_id', 'language_id')
+
+
+def _keyset_page(query, model, after=None, descending=True):
+    """Rows of query, ordered by (datetime, id), following cursor after
+
+    Returns the rows and the cursor of the next page, None on the last
+    page. Raises ValueError if after is not a cursor.
+    """
+    if after:
+        when, _, row_id = after.rpartition('_')
+        when = datetime.datetime.fromisoformat(when)
+        row_id = int(row_id)
+        if descending:
+            query = query.filter(sqlalchemy.or_(
+                model.datetime < when,
+                sqlalchemy.and_(model.datetime == when, model.id < row_id)))
+        else:
+            query = query.filter(sqlalchemy.or_(
+                model.datetime > when,
+                sqlalchemy.and_(model.datetime == when, model.id > row_id)))
+    if descending:
+        query = query.order_by(model.datetime.desc(), model.id.desc())
+    else:
+        query = query.order_by(model.datetime, model.id)
+    rows = query.limit(PAGE_SIZE + 1).all()
+    if len(rows) <= PAGE_SIZE:
+        return rows, None
+    rows = rows[:PAGE_SIZE]
+    return rows, f'{rows[-1].datetime.isoformat()}_{rows[-1].id}'
+
+
+def _page_url(endpoint, after, **values):
+    """Url of the page after cursor, None if there is none"""
+    if after is None:
+        return None
+    args = {k: v for k, v in request.args.items() if v}
+    args.update(values, after=after)
+    return url_for(endpoint, **args)
+
+
 @app.route('/competitions')
 @login_required
 def users():
-    users = models.User.query.all()
-    return render_template('users.html', users=users)
+    try:
+        users, after = _keyset_page(models.User.query, models.User,
+                                    request.args.get('after'),
+                                    descending=False)
+    except ValueError:
+        return f'Invalid page "{request.args.get("after")}"'
+    return render_template('users.html', users=users,
+                           next_users=_page_url('users_rows', after))
+
+
+@app.route('/competitions/rows')
+@login_required
+def users_rows():
+    """Page of the competitions table, as table rows or json"""
+    try:
+        users, after = _keyset_page(models.User.query, models.User,
+                                    request.args.get('after'),
+                                    descending=False)
+    except ValueError:
+        return f'Invalid page "{request.args.get("after")}"', 400
+    if request.args.get('format') == 'json':
+        return jsonify(
+            rows=[dict(username=u.username, real_name=u.real_name,
+                       country=u.country, datetime=u.datetime.isoformat())
+                  for u in users],
+            next=_page_url('users_rows', after))
+    return render_template('user_rows.html', users=users,
+                           next_page=_page_url('users_rows', after))
+
+
+def _filter_memos(query, args):
+    """Filter query of memos on the discipline, state and language args
+
+    Raises KeyError for an unknown discipline or state.
+    """
+    if args.get('discipline'):
+        query = query.filter(
+            models.MemoData.discipline == models.Discipline[args['discipline']])
+    if args.get('state'):
+        query = query.filter(
+            models.MemoData.state == models.State[args['state']])
+    if args.get('language'):
+        language_id = sqlalchemy.select([models.Language.id]).where(
+            models.Language.language == args['language']).as_scalar()
+        query = query.filter(models.MemoData.language_id == language_id)
+    return query
+
+
+def _user_memos(user):
+    return models.MemoData.query.filter_by(user_id=user.id).options(
+        sqlalchemy.orm.load_only(*MEMO_COLUMNS),
+        sqlalchemy.orm.joinedload(models.MemoData.language))
+
+
+def _user_recalls(user):
+    return models.RecallData.query.join(models.RecallData.memo).filter(
+        models.MemoData.user_id == user.id
+    ).options(
+        sqlalchemy.orm.load_only('id', 'datetime', 'time_remaining',
+                                 'locked', 'user_id', 'memo_id'),
+        sqlalchemy.orm.contains_eager(
+            models.RecallData.memo).load_only(*MEMO_COLUMNS),
+        sqlalchemy.orm.contains_eager(
+            models.RecallData.memo).joinedload(models.MemoData.language),
+        sqlalchemy.orm.joinedload(
+            models.RecallData.user).load_only('id', 'username'),
+        sqlalchemy.orm.joinedload(
+            models.RecallData.correction).load_only(
+                'id', 'points', 'raw_score', 'correct', 'consecutive',
+                'recall_id'))
+
+
+def _user_page(user, table, after=None):
+    """Filtered page of the memos or recalls of user, and next cursor"""
+    if table == 'memos':
+        query, model = _user_memos(user), models.MemoData
+    else:
+        query, model = _user_recalls(user), models.RecallData
+    return _keyset_page(_filter_memos(query, request.args), model, after)
+
+
+def _score_visible(recall, users_home_page):
+    """True if the current user may see the score of recall"""
+    return (users_home_page
+            or recall.memo.user_id == recall.user_id
+            or recall.memo.state == models.State.public
+            or (recall.user_id == current_user.id and recall.locked))
+
+
+def _memo_json(memo):
+    return dict(id=memo.id, datetime=memo.datetime.isoformat(),
+                discipline=memo.discipline.name, memo_time=memo.memo_time,
+                recall_time=memo.recall_time, nr_items=memo.nr_items,
+                language=memo.language and memo.language.language,
+                state=memo.state.name)
+
+
+def _recall_json(recall, users_home_page):
+    row = dict(id=recall.id, datetime=recall.datetime.isoformat(),
+               memo=_memo_json(recall.memo), user=recall.user.username,
+               time_remaining=None, points=None, raw_score=None,
+               correct=None, consecutive=None)
+    if _score_visible(recall, users_home_page):
+        row['time_remaining'] = recall.time_remaining
+        if recall.correction is not None:
+            row.update(points=recall.correction.points,
+                       raw_score=recall.correction.raw_score,
+                       correct=recall.correction.correct,
+                       consecutive=recall.correction.consecutive)
+    return row
 
 
 def _user(username, delete_column=False):
@@ -304,11 +487,28 @@ def _user(username, delete_column=False):
             flash('Settings successfully updated', 'success')
         return redirect(url_for('user', username=current_user.username))
 
-    r = models.RecallData.query.join(models.RecallData.memo).filter(
-        models.MemoData.user_id==user.id)
-    return render_template('user.html', user=user,
-                           users_home_page=(user.id == current_user.id),
-                           recalls=r, delete_column=delete_column)
+    # Only the first page of each table is loaded, in one query each
+    # with only the columns shown, the rest are fetched when asked for
+    try:
+        memos, memos_after = _user_page(user, 'memos')
+        recalls, recalls_after = _user_page(user, 'recalls')
+    except KeyError as err:
+        return f'Invalid filter {err}'
+    languages = db.session.query(models.Language.language).join(
+        models.MemoData).filter(models.MemoData.user_id == user.id
+    ).distinct().order_by(models.Language.language).all()
+    delete = dict(delete_column=1) if delete_column else dict()
+    return render_template(
+        'user.html', user=user,
+        users_home_page=(user.id == current_user.id),
+        memos=memos, recalls=recalls, delete_column=delete_column,
+        next_memos=_page_url('user_memos', memos_after,
+                             username=user.username, **delete),
+        next_recalls=_page_url('user_recalls', recalls_after,
+                               username=user.username, **delete),
+        disciplines=list(models.Discipline), states=list(models.State),
+        languages=[language for language, in languages],
+        filters=request.args)
 
 
 @app.route('/competition/<string:username>', methods=['GET', 'POST'])
@@ -323,6 +523,43 @@ def user_delete_column(username):
     return _user(username, delete_column=True)
 
 
+def _user_rows(username, table):
+    """Page of the memo or recall table of user, as table rows or json"""
+    username = username.strip().lower()
+    try:
+        user = models.User.query.filter_by(username=username).one()
+    except sqlalchemy.orm.exc.NoResultFound:
+        return f'No such user "{username}"', 404
+    try:
+        rows, after = _user_page(user, table, request.args.get('after'))
+    except (KeyError, ValueError) as err:
+        return f'Invalid filter or page {err}', 400
+    users_home_page = user.id == current_user.id
+    next_page = _page_url(request.endpoint, after, username=user.username)
+    if request.args.get('format') == 'json':
+        if table == 'memos':
+            rows = [_memo_json(memo) for memo in rows]
+        else:
+            rows = [_recall_json(r, users_home_page) for r in rows]
+        return jsonify(rows=rows, next=next_page)
+    return render_template(
+        f'{table[:-1]}_rows.html', user=user, **{table: rows},
+        users_home_page=users_home_page, next_page=next_page,
+        delete_column=bool(request.args.get('delete_column')))
+
+
+@app.route('/competition/<string:username>/memos')
+@login_required
+def user_memos(username):
+    return _user_rows(username, 'memos')
+
+
+@app.route('/competition/<string:username>/recalls')
+@login_required
+def user_recalls(username):
+    return _user_rows(username, 'recalls')
+
+
 @app.route('/make', methods=['GET', 'POST'])
 @login_required
 def make_discipline():
@@ -331,24 +568,118 @@ def make_discipline():
         return render_template('make.html')
     elif request.method == 'POST':
         try:
-            memo = models.MemoData.from_request(request, current_user)
+            memo = models.MemoData.from_request(
+                request, current_user, seeded=app.config['SEEDED_MEMOS'])
+            if len(memo) == 0:
+                if memo.language is None:
+                    return 'Failed to create discipline!'
+                else:
+                    return ('Failed to create discipline. '
+                            'Maybe the database has no data for language = '
+                            f'"{memo.language.language}" ?')
         except (models.InvalidHistoricalDate, ValueError) as error:
             return 'Failed to create discipline: ' + str(error)
-
-        if len(memo.data) == 0:
-            if memo.language is None:
-                return 'Failed to create discipline!'
-            else:
-                return ('Failed to create discipline. '
-                        'Maybe the database has no data for language = '
-                        f'"{memo.language.language}" ?')
         db.session.add(memo)
         db.session.commit()
         app.logger.info(
             f'User {current_user.username} created memorization {memo}')
+        sheets.prerender(memo, current_user.settings)
         return 'Successfully created discipline'
 
 
+@app.route('/make/batch', methods=['POST'])
+@login_required
+def make_batch():
+    """Create memorizations of a list of specs in one transaction
+
+    The JSON body is {"memos": [spec, ...], "xls": false}, where each
+    spec has the fields of the /make form (discipline, time, nr_items
+    or data, language) and optionally pattern and card_colors of its
+    sheet. If xls is true, the sheets are rendered before returning.
+    """
+    body = request.get_json(force=True, silent=True) or dict()
+    specs = body.get('memos')
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': 'No memorizations to create'})
+    memos = list()
+    patterns = list()
+    for i, spec in enumerate(specs):
+        try:
+            form = {key: str(value) for key, value in spec.items()}
+            memo = models.MemoData.from_form(
+                form, request.remote_addr, current_user,
+                seeded=app.config['SEEDED_MEMOS'])
+            if len(memo) == 0:
+                raise ValueError('No data, maybe the database has no data '
+                                 'for this language?')
+            pattern = form.get('pattern')
+            if pattern:
+                pattern = recall.xls.verify_and_clean_pattern(pattern)
+        except (models.InvalidHistoricalDate, ValueError, KeyError,
+                AttributeError) as error:
+            db.session.rollback()
+            return jsonify({'error': f'Failed to create memorization {i}: '
+                                     f'{error}'})
+        db.session.add(memo)
+        memos.append(memo)
+        patterns.append(pattern)
+    db.session.commit()
+    app.logger.info(f'User {current_user.username} created memorizations '
+                    f'{memos}')
+
+    result = [dict(id=memo.id, discipline=memo.discipline.name,
+                   recall=url_for('recall_', memo_id=memo.id))
+              for memo in memos]
+    jobs = list()
+    for spec, memo, pattern, memo_result in zip(specs, memos, patterns,
+                                                result):
+        if memo.discipline == models.Discipline.spoken:
+            memo_result['play'] = url_for('play_spoken', memo_id=memo.id)
+            continue
+        card_colors = spec.get('card_colors') in (True, 'True')
+        memo_result['xls'] = url_for(
+            'download_xls', memo_id=memo.id, pattern=pattern or None,
+            card_colors=card_colors or None)
+        jobs.append((memo, pattern, card_colors))
+    if body.get('xls'):
+        sheets.render_many(jobs)
+    return jsonify({'memos': result})
+
+
+def _send_file(directory, filename, **kwargs):
+    """send_from_directory, or let the front web server send the file
+
+    With SENDFILE 'x-accel' the response has an X-Accel-Redirect to
+    SENDFILE_PREFIX and the path of the file in the application, for
+    an internal nginx location:
+
+        location /protected/ {
+            internal;
+            alias /home/pi/total-recall/recall/;
+        }
+
+    With 'x-sendfile' it has an X-Sendfile header with the absolute
+    path, for Apache mod_xsendfile or lighttpd. The headers of the
+    response, like Content-Disposition, are made by Flask either way,
+    but only without SENDFILE, as in development, the file is read.
+    """
+    response = send_from_directory(directory, filename, **kwargs)
+    mode = app.config['SENDFILE']
+    if not mode or response.status_code != 200:
+        return response
+    response.close()
+    response.response = []
+    del response.headers['Content-Length']
+    path = os.path.join(directory, filename)
+    if mode == 'x-accel':
+        relative_path = os.path.relpath(path, app.root_path)
+        response.headers['X-Accel-Redirect'] = urllib.parse.quote(
+            f"{app.config['SENDFILE_PREFIX']}/{relative_path}")
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+
 @app.route('/xls/<int:memo_id>', methods=['GET'])
 @login_required
 def download_xls(memo_id: int):
@@ -356,6 +687,10 @@ def download_xls(memo_id: int):
     if pattern:
         pattern = recall.xls.verify_and_clean_pattern(pattern)
     # pattern will now be either None or a nice string
+    file_format = request.args.get('format', 'xls')
+    if file_format not in recall.xls.FORMATS:
+        return f'Sheets can not be downloaded in format "{file_format}"'
+
     try:
         memo = models.MemoData.query.filter_by(id=memo_id).one()
     except sqlalchemy.orm.exc.NoResultFound:
@@ -366,8 +701,6 @@ def download_xls(memo_id: int):
     elif memo.discipline == models.Discipline.cards:
         card_colors = request.args.get('card_colors')
         card_colors = (card_colors == 'True')
-        memo.get_xls_filedata = functools.partial(
-            memo.get_xls_filedata, card_colors=card_colors)
     else:
         card_colors = False
 
@@ -378,16 +711,63 @@ def download_xls(memo_id: int):
         if memo.state != models.State.public:
             return 'Download not allowed.'
 
-    filename = memo.get_xls_filename(pattern, card_colors)
-    fullfile = os.path.join(app.root_path, f'xls/{filename}')
-    if not os.path.isfile(fullfile):
-        filedata = memo.get_xls_filedata(pattern)
-        with open(fullfile, 'wb') as h:
-            h.write(filedata.getvalue())
-    app.logger.info(f'{current_user.username} downloads {filename}')
-    return send_from_directory(os.path.join(app.root_path, 'xls'),
-                               filename,
-                               as_attachment=True)
+    filename = sheets.render(memo, pattern, card_colors, file_format)
+    download_name = memo.get_xls_filename(pattern, card_colors, file_format)
+    app.logger.info(f'{current_user.username} downloads {download_name}')
+    return _send_file(os.path.join(app.root_path, 'xls'),
+                      filename,
+                      as_attachment=True,
+                      download_name=download_name)
+
+
+@app.route('/xls/bundle', methods=['GET'])
+@login_required
+def download_bundle():
+    """ZIP archive of sheets, streamed as they are rendered
+
+    The sheets are those of the memo_id arguments, or of the
+    memorizations in Competition state of the user argument, with the
+    pattern settings of the current user.
+    """
+    file_format = request.args.get('format', 'xls')
+    if file_format not in recall.xls.FORMATS:
+        return f'Sheets can not be downloaded in format "{file_format}"'
+    username = request.args.get('user')
+    if username:
+        memos = models.MemoData.query.join(models.User).filter(
+            models.User.username == username.strip().lower(),
+            models.MemoData.state == models.State.competition)
+        archive_name = f'{username.strip().lower()}_competition.zip'
+    else:
+        try:
+            memo_ids = {int(i) for i in request.args.getlist('memo_id')}
+        except ValueError:
+            return 'Invalid memo id'
+        memos = models.MemoData.query.filter(
+            models.MemoData.id.in_(memo_ids))
+        archive_name = 'sheets.zip'
+    memos = memos.order_by(models.MemoData.id).all()
+    if not memos:
+        return 'No memorizations to download'
+
+    jobs = list()
+    for memo in memos:
+        # Same rule as download_xls
+        if memo.user_id != current_user.id:
+            if memo.state != models.State.public:
+                return f'Download of memo {memo.id} not allowed.'
+        sheet = sheets.settings_pattern(memo, current_user.settings)
+        if sheet is None:
+            continue
+        pattern, card_colors = sheet
+        name = memo.get_xls_filename(pattern, card_colors, file_format)
+        jobs.append((memo, pattern, card_colors, file_format, name))
+    app.logger.info(f'{current_user.username} downloads {archive_name} '
+                    f'of {len(jobs)} sheets')
+    return Response(
+        stream_with_context(sheets.bundle(jobs)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={archive_name}'})
 
 
 @app.route('/play/<int:memo_id>', methods=['GET'])
@@ -476,7 +856,13 @@ def recall_(memo_id):
 @app.route('/arbeiter', methods=['POST'])
 def arbeiter():
     # Todo: Backup solution if commit fails
-    """Accept posted recall data, correct, and store in database"""
+    """Accept posted recall data, correct, and store in database
+
+    The recall is read and written with plain SQL statements in a
+    single transaction, no ORM objects are loaded unless the recall
+    is corrected. Intermediate autosaves of an existing recall are
+    only written to the autosave journal, see recall.journal.
+    """
 
     # Make sure a user is logged in
     if not current_user.is_authenticated:
@@ -486,75 +872,196 @@ def arbeiter():
     arbeiter = f'{current_user.username}\'s Arbeiter:'
     app.logger.info(f'{arbeiter}: Got recall data from competitor')
 
-    # There must exist a corresponding memorization for this
-    # Recall in the database
-    memo_id = int(request.form['memo_id'])
-    memo = models.MemoData.query.filter_by(id=memo_id).one()
+    form = request.form
+    memo_id = int(form['memo_id'])
+    user_id = int(form['user_id'])
+
+    # Autosaves not yet flushed from the journal are the most
+    # recent version of the recall.
+    write_behind = (journal.enabled() and form['locked'] != 'true'
+                    and not app.config['LIVE_CORRECTION'])
+    row = journal.get(memo_id, user_id) if journal.enabled() else None
+    if row is not None:
+        return _store_recall(arbeiter, row, memo_id, user_id, write_behind)
+    return _store_recall_from_database(arbeiter, memo_id, user_id,
+                                       write_behind)
 
-    # Check if there already exists a recall entry for this
-    # memorization and user in the database.
-    user_id = int(request.form['user_id'])
-    recall = memo.recalls.filter_by(user_id=user_id).first()
 
-    if recall:
+def _store_recall_from_database(arbeiter, memo_id, user_id, write_behind):
+    """Store recall of form in request, as stored in the database"""
+    # There must exist a corresponding memorization for this
+    # Recall in the database. Get it together with the existing
+    # recall entry for this memorization and user, if any.
+    memo_table = models.MemoData.__table__
+    recall_table = models.RecallData.__table__
+    columns = [memo_table.c.user_id.label('memo_user_id'),
+               recall_table.c.id, recall_table.c.user_id,
+               recall_table.c.locked, recall_table.c.seq,
+               recall_table.c.digest]
+    if request.form.get('delta') == 'true':
+        columns.append(recall_table.c.data)
+    query = sqlalchemy.select(columns).select_from(
+        memo_table.outerjoin(recall_table, sqlalchemy.and_(
+            recall_table.c.memo_id == memo_table.c.id,
+            recall_table.c.user_id == user_id))
+    ).where(memo_table.c.id == memo_id)
+    row = db.session.execute(query).first()
+    if row is None:
+        app.logger.warning(f'{arbeiter}: Memo {memo_id} does not exist')
+        return jsonify({'error': 'Memorization does not exist'})
+    return _store_recall(arbeiter, row, memo_id, user_id, write_behind)
+
+
+def _store_recall(arbeiter, row, memo_id, user_id, write_behind):
+    """Store recall of form in request, correct it if locked
+
+    row has the memorization owner and the stored recall (None
+    fields if not stored) as fetched by arbeiter. If write_behind is
+    True, an existing recall is only stored in the autosave journal.
+    """
+    form = request.form
+    delta = form.get('delta') == 'true'
+    recall_table = models.RecallData.__table__
+    values = dict(
+        datetime=datetime.datetime.utcnow(),
+        ip=request.remote_addr,
+        time_remaining=float(form['seconds_remaining']),
+    )
+    changed = None
+    if row.id is not None:
         app.logger.debug(f'{arbeiter}: Found existing recall for competitor: '
-                         f'recall {recall.id}')
-        if recall.locked is True and user_id != memo.user_id:
+                         f'recall {row.id}')
+        if row.locked is True and user_id != row.memo_user_id:
             # If the recall is locked, no further submits will
             # be accepted - unless the user is the owner of the
             # memorization, then he can recall as many times he
             # wants.
-            app.logger.warning(f'{arbeiter}: Recall {recall.id} is locked')
+            app.logger.warning(f'{arbeiter}: Recall {row.id} is locked')
             return jsonify({'error': 'Recall is locked'})
 
-        if recall.user_id == current_user.id:
-            # Update the recall instance with new field values
-            recall.__init__(request)
-        else:
+        if row.user_id != current_user.id:
             # In this case the Arbeiter got recall data of a
             # user who is no longer logged in - that is not
             # allowed.
             app.logger.warning(f'{arbeiter}: Wrong user logged in')
             return jsonify({'error': 'User not logged in'})
+
+        # Update the recall with new field values
+        if delta:
+            # Only cells changed since last acknowledged submit
+            try:
+                values['data'], changed = models.RecallData.patch_cells(
+                    row.data, row.seq, form)
+            except models.RecallOutOfSync as error:
+                app.logger.warning(f'{arbeiter}: {error}')
+                return jsonify({'resync': True, 'seq': row.seq})
+        else:
+            values['data'] = models.RecallData.cells_from_form(form)
+            values['locked'] = False
+        values['seq'] = row.seq + 1
+        recall_id = row.id
+    elif delta:
+        # A delta can't be applied to a recall that doesn't exist
+        app.logger.warning(f'{arbeiter}: Got delta of unknown recall')
+        return jsonify({'resync': True, 'seq': None})
     else:
-        app.logger.debug(f'{arbeiter}: First time recall of memo {memo.id}')
-        # Create a new recall object and add to database
-        recall = models.RecallData(request)
-        recall.user = current_user
-        recall.memo = memo
-        db.session.add(recall)
+        app.logger.debug(f'{arbeiter}: First time recall of memo {memo_id}')
+        values.update(
+            data=models.RecallData.cells_from_form(form),
+            locked=False,
+            seq=1,
+            user_id=current_user.id,
+            memo_id=memo_id
+        )
+        recall_id = None
 
     # In the final submit the client should send a signal to
     # lock the recall, so no further recalls will be accepted.
     # (unless the client is the owner of the memorization)
-    if request.form['locked'] == 'true':
-        app.logger.info(f'{arbeiter}: Recall {recall.id} is now locked')
-        recall.locked = True
-
-    db.session.commit()
-
-    raw_score, points, cbc_r = recall.correct()
-
-    if recall.correction:
-        app.logger.debug(f'{arbeiter}: Re-correcting recall {recall.id}')
-        recall.correction.__init__(raw_score, points, cbc_r)
+    if form['locked'] == 'true':
+        values['locked'] = True
+    values.setdefault('locked', row.locked)
+    values['digest'] = models.RecallData.digest_cells(values['data'])
+
+    if (recall_id is not None and form['locked'] != 'true'
+            and values['digest'] == row.digest
+            and values['locked'] == row.locked):
+        # Nothing changed since the stored submit
+        metrics.incr('autosave.deduplicated')
+        app.logger.debug(f'{arbeiter}: Recall {recall_id} unchanged')
+        return _recall_received(row.seq)
+
+    if write_behind and recall_id is not None:
+        journal.put(memo_id, user_id, recall_id, row.memo_user_id, values)
+        return _recall_received(values['seq'])
+
+    if recall_id is None:
+        try:
+            result = db.session.execute(
+                recall_table.insert().values(**values))
+        except sqlalchemy.exc.IntegrityError:
+            # A concurrent first submit stored the recall before us
+            db.session.rollback()
+            app.logger.info(f'{arbeiter}: Recall of memo {memo_id} '
+                            f'stored meanwhile, updating it')
+            return _store_recall_from_database(arbeiter, memo_id, user_id,
+                                               write_behind)
+        recall_id = result.inserted_primary_key[0]
     else:
-        app.logger.debug(
-            f'{arbeiter}: Correcting recall {recall.id} for the first time')
-        correction = models.Correction(raw_score, points, cbc_r)
-        correction.recall = recall
-        db.session.add(correction)
-
+        result = db.session.execute(recall_table.update().where(
+            recall_table.c.id == recall_id).values(**values))
+        if result.rowcount == 0:
+            # Deleted since it was read, from the journal or the
+            # database, store it again as a first submit (or resync)
+            db.session.rollback()
+            if journal.enabled():
+                journal.discard(memo_id, user_id)
+            app.logger.warning(f'{arbeiter}: Recall {recall_id} is gone')
+            return _store_recall_from_database(arbeiter, memo_id, user_id,
+                                               write_behind)
+    if values.get('locked') is True:
+        app.logger.info(f'{arbeiter}: Recall {recall_id} is now locked')
+        if corrections.enabled():
+            # Acknowledge now, the workers correct it
+            db.session.commit()
+            if journal.enabled():
+                journal.discard(memo_id, user_id)
+            corrections.enqueue(recall_id, values['seq'])
+            app.logger.info(f'{arbeiter}: Queued correction of {recall_id}')
+            return jsonify({
+                'queued': True,
+                'seq': values['seq'],
+                'result': url_for('correction_result', recall_id=recall_id)
+            })
+
+    # Intermediate autosaves are only stored, the correction is done
+    # when the recall is locked (unless live scoring is configured).
+    if values.get('locked') is True or app.config['LIVE_CORRECTION']:
+        recall = models.RecallData.query.options(
+            sqlalchemy.orm.joinedload(models.RecallData.memo).undefer('_data'),
+            sqlalchemy.orm.joinedload(models.RecallData.correction)
+        ).filter_by(id=recall_id).one()
+        corrections.correct(recall, arbeiter, changed=changed)
+        app.logger.info(f'{arbeiter} has corrected recall of memo {memo_id}')
+        if recall.locked is True:
+            result = dict(recall.correction)
+            db.session.commit()
+            if journal.enabled():
+                journal.discard(memo_id, user_id)
+            return jsonify(result)
     db.session.commit()
+    if journal.enabled():
+        journal.discard(memo_id, user_id)
+    return _recall_received(values['seq'])
 
-    app.logger.info(recall.correction)
 
-    app.logger.info(f'Arbeiter has corrected {recall.user.username}\'s '
-                    f'recall of memo {recall.memo.id}')
-    if recall.locked is True:
-        return jsonify(dict(recall.correction))
-    else:
-        return jsonify({'success': 'Recall received'})
+def _recall_received(seq):
+    """Acknowledge autosave, tell client when to send the next one"""
+    return jsonify({
+        'success': 'Recall received',
+        'seq': seq,
+        'next_autosave': round(schedule.scheduler.next_delay(), 3)
+    })
 
 
 @app.route('/arbeiter/correct/<int:recall_id>')
@@ -567,21 +1074,47 @@ def recorrect(recall_id):
         return f'Does not exists'
     if recall.memo.user_id != current_user.id:
         return 'Not allowed. This user do not own the memorization'
-    raw_score, points, cbc_r = recall.correct()
-    old = recall.correction
-    recall.correction = models.Correction(raw_score, points, cbc_r)
-    db.session.delete(old)
-    db.session.commit()
+    if corrections.enabled():
+        if recall.correction:
+            # Outdated until the workers are done
+            recall.correction.seq = None
+            db.session.commit()
+        corrections.enqueue(recall_id, recall.seq, full=True)
+    else:
+        corrections.correct(recall, incremental=False)
+        db.session.commit()
     return redirect(url_for('view_recall', recall_id=recall_id))
 
 
+@app.route('/arbeiter/result/<int:recall_id>')
+@login_required
+def correction_result(recall_id):
+    """Correction of a final submit, or pending if not corrected yet"""
+    recall = models.RecallData.query.options(
+        sqlalchemy.orm.joinedload(models.RecallData.memo),
+        sqlalchemy.orm.joinedload(
+            models.RecallData.correction).undefer('_cell_by_cell')
+    ).filter_by(id=recall_id).one_or_none()
+    if recall is None:
+        return jsonify({'error': 'Recall does not exist'})
+    if current_user.id not in (recall.user_id, recall.memo.user_id):
+        return jsonify({'error': 'Not allowed to view recall'})
+    if not corrections.is_corrected(recall):
+        return jsonify({'pending': True})
+    return jsonify(dict(recall.correction))
+
+
 @app.route('/recall/view/<int:recall_id>')
 @login_required
 def view_recall(recall_id):
     """View recall"""
     # Todo: make viewable without being logged in
     try:
-        recall = models.RecallData.query.filter_by(id=recall_id).one()
+        recall = models.RecallData.query.options(
+            sqlalchemy.orm.joinedload(models.RecallData.memo).undefer('_data'),
+            sqlalchemy.orm.joinedload(
+                models.RecallData.correction).undefer('_cell_by_cell')
+        ).filter_by(id=recall_id).one()
     except sqlalchemy.orm.exc.NoResultFound:
         return f'Does not exists'
 
@@ -594,6 +1127,18 @@ def view_recall(recall_id):
     app.logger.info(
         f'User {current_user.username} view recall {recall_id}')
 
+    # The page polls for the result of a recall in the correction
+    # queue, one still in progress is corrected here (autosaves are
+    # not corrected)
+    pending = None
+    if corrections.is_pending(recall):
+        pending = url_for('correction_result', recall_id=recall_id)
+        result = 'null'
+    elif corrections.is_corrected(recall):
+        result = json.dumps(dict(recall.correction))
+    else:
+        result = json.dumps(dict(models.Correction(*recall.correct())))
+
     nr_items = len(recall.memo.data)
     seconds_remaining = recall.time_remaining
     if recall.memo.discipline == models.Discipline.base2:
@@ -605,7 +1150,7 @@ def view_recall(recall_id):
                                seconds_remaining=seconds_remaining,
                                view=True,
                                recall=recall,
-                               result=json.dumps(dict(recall.correction)))
+                               result=result, pending=pending)
     elif recall.memo.discipline == models.Discipline.base10\
             or recall.memo.discipline == models.Discipline.spoken:
         nr_rows = math.ceil(nr_items/NR_DIGITS_IN_ROW_DECIMALS)
@@ -616,7 +1161,7 @@ def view_recall(recall_id):
                                seconds_remaining=seconds_remaining,
                                view=True,
                                recall=recall,
-                               result=json.dumps(dict(recall.correction)))
+                               result=result, pending=pending)
     elif recall.memo.discipline == models.Discipline.words:
         # Compute the total nr of columns (acc over all pages)
         nr_cols = int(math.ceil(nr_items/NR_WORDS_IN_COLUMN))
@@ -632,7 +1177,7 @@ def view_recall(recall_id):
                                seconds_remaining=seconds_remaining,
                                view=True,
                                recall=recall,
-                               result=json.dumps(dict(recall.correction)))
+                               result=result, pending=pending)
     elif recall.memo.discipline == models.Discipline.dates:
         return render_template('recall_dates.html', memo=recall.memo,
                                data=sorted(recall.memo.data, key=lambda x: x[2]),
@@ -640,7 +1185,7 @@ def view_recall(recall_id):
                                seconds_remaining=seconds_remaining,
                                view=True,
                                recall=recall,
-                               result=json.dumps(dict(recall.correction)))
+                               result=result, pending=pending)
     else:
         return f'Recall not yet implemented for {recall.memo.discipline.value}'
 
@@ -668,6 +1213,7 @@ def db_stories_capitalize():
                 nr_modified += 1
                 db.session.add(story)
         db.session.commit()
+        models.Story.invalidate_pool()
         flash(f'Nr of stories modified: {nr_modified}', 'success')
         return redirect(url_for('db_stories'))
 
@@ -699,6 +1245,7 @@ def db_stories_reloadcase():
                 nr_modified += 1
                 db.session.add(story)
     db.session.commit()
+    models.Story.invalidate_pool()
     flash(f'Nr of stories modified: {nr_modified}', 'success')
     return redirect(url_for('db_stories'))
 
@@ -766,6 +1313,7 @@ def table_stories():
                     db.session.add(s)
                     nr_success += 1
         db.session.commit()
+        models.Story.invalidate_pool()
         if nr_success == 1:
             flash(f'Story successfully added to the database.',
                   'success')
@@ -869,6 +1417,7 @@ def table_words():
                     db.session.add(w)
                     nr_added += 1
         db.session.commit()
+        models.Word.invalidate_pool()
         if nr_exist > 0:
             plural = 's' if nr_exist > 1 else ''
             flash(f'{nr_exist} word{plural} already exist in database. Not added',
@@ -931,9 +1480,29 @@ def table_almost_correct_words():
         m.language = models.Language.find_or_add(language)
         m.user = current_user
         db.session.commit()
+        models.AlmostCorrectWord.invalidate(m.user_id)
         return 'Done'
 
 
+@app.route('/metrics')
+@login_required
+def metrics_():
+    """Counters of the running server"""
+    return jsonify(dict(metrics.counters))
+
+
+@app.route('/static/spoken/<path:filename>')
+def spoken_audio(filename):
+    """Audio of Spoken Numbers, served like the static files"""
+    return _send_file(os.path.join(app.static_folder, 'spoken'), filename)
+
+
+@app.route('/static/images/<path:filename>')
+def images_file(filename):
+    """PDF of images, served like the static files"""
+    return _send_file(os.path.join(app.static_folder, 'images'), filename)
+
+
 @app.route('/images')
 def images_pdf():
     root = os.path.join(app.root_path, f'static/images')